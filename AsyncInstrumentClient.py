@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:12:45 2026
+
+asyncio client of the instrument server. Requests of all AsyncInstrumentClients
+of an event loop share one connection and can be in flight at the same time,
+so e.g. reading several instruments takes as long as the slowest of them:
+
+    async with (AsyncInstrumentClient('GPIB0::12::INSTR') as dmm,
+                AsyncInstrumentClient('ASRL3::INSTR') as bridge):
+        v, r = await asyncio.gather(dmm.query('READ?'), bridge.query('RDGR? A'))
+"""
+
+import asyncio
+import logging as log
+import pickle
+import weakref
+import numpy as np
+from . import InstrumentProtocol as proto
+from .InstrumentClient import server_address, job_request
+
+class AsyncServerConnection:
+    """
+    One connection to the instrument server, shared by the AsyncInstrumentClients
+    of an event loop with the same server and connection settings (see
+    server_connection()). A reader task resolves the futures of the pending
+    requests by request id. A broken connection fails the pending requests and
+    is re-established by the next request, which reopens the instruments of the
+    attached clients.
+    """
+    def __init__(self, address, family=None, setup=()):
+        self.address = address
+        self.family = family
+        self.setup = setup # (opcode, payload) requests sent on every new connection
+        self.writer = None
+        self.reader_task = None
+        self.connect_lock = asyncio.Lock()
+        self.request_id = 0
+        self.pending = {} # request id -> future of the reply
+        self.clients = weakref.WeakSet()
+    
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+    
+    async def ensure_connected(self):
+        async with self.connect_lock:
+            if self.connected:
+                return
+            reconnect = self.writer is not None
+            if reconnect:
+                log.warning(f"Reconnecting to the instrument server at {self.address}")
+            if self.family == 'AF_UNIX':
+                reader, self.writer = await asyncio.open_unix_connection(self.address)
+            else:
+                reader, self.writer = await asyncio.open_connection(*self.address)
+            self.reader_task = asyncio.create_task(self.receive(reader, self.writer))
+            for opcode, payload in self.setup:
+                await self.exchange(opcode, 0, payload)
+            if reconnect:
+                for client in list(self.clients):
+                    await client.reopen()
+    
+    async def receive(self, reader, writer):
+        "Reader task, hands the replies to the waiting requests."
+        try:
+            while True:
+                status, resource_id, request_id, payload = proto.unpack_frame(await proto.read_message(reader))
+                if status in (proto.STATUS_PUBLISH, proto.STATUS_PUBLISH_ERROR):
+                    continue # no subscriptions in the asyncio client
+                future = self.pending.pop(request_id, None)
+                if future is None:
+                    log.warning(f"Discarding reply to unknown request {request_id}")
+                elif not future.done():
+                    future.set_result((status, resource_id, payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            error = e
+        except asyncio.CancelledError:
+            error = ConnectionError("Connection to the instrument server closed")
+        writer.close()
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection to the instrument server lost: {error}"))
+    
+    async def exchange(self, opcode, resource_id, payload=b''):
+        self.request_id = (self.request_id + 1) & proto.MAX_REQUEST_ID
+        request_id = self.request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.writer.write(proto.frame_message(proto.pack_frame(opcode, resource_id,
+                                                                   request_id, payload)))
+            await self.writer.drain()
+        except ConnectionError:
+            self.pending.pop(request_id, None)
+            raise
+        return await future
+    
+    def attach(self, client):
+        self.clients.add(client)
+    
+    async def detach(self, client):
+        "Removes the client, the connection is closed once no client uses it."
+        self.clients.discard(client)
+        if self.clients:
+            return
+        release_connection(self)
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+connections = weakref.WeakKeyDictionary() # event loop -> {(address, family, setup): AsyncServerConnection}
+
+def server_connection(address, family=None, setup=()) -> AsyncServerConnection:
+    "The connection of the running event loop to the server at address with the given settings."
+    loop_connections = connections.setdefault(asyncio.get_running_loop(), {})
+    key = (address, family, setup)
+    if key not in loop_connections:
+        loop_connections[key] = AsyncServerConnection(address, family, setup)
+    return loop_connections[key]
+
+def release_connection(connection):
+    loop_connections = connections.get(asyncio.get_running_loop(), {})
+    key = (connection.address, connection.family, connection.setup)
+    if loop_connections.get(key) is connection:
+        del loop_connections[key]
+
+class AsyncInstrumentClient:
+    """
+    asyncio version of InstrumentClient for the binary protocol, all requests
+    are coroutines. Use it as an async context manager, or await open() and
+    disconnect().
+    
+    The server is found like by InstrumentClient, also through a directory,
+    and compression and request timeouts work the same.
+    
+    Shared memory, subscriptions and locks are only available in InstrumentClient,
+    a lock would be leased to the connection shared by all clients of the loop.
+    """
+    def __init__(self, visa_addr, remote_address='localhost', port=None,
+                 port_filename='instrument_server_port.txt', priority='acquisition', unix_socket=True,
+                 directory=None, compression=None, compression_threshold=1 << 12, request_timeout=None):
+        if priority not in proto.PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}")
+        if compression is not None and not proto.compression_available(proto.COMPRESSION.get(compression)):
+            raise ValueError(f"Compression {compression} not available")
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.request_timeout = request_timeout
+        self.visa_addr = visa_addr
+        self.priority = priority
+        self.resource_id = 0 # assigned by the server in open()
+        self.server = None
+        self.macros = {} # name -> steps of the macros defined by this client
+        self.jobs = {} # job id -> dtype of the job's data
+        self.address, self.family = server_address(remote_address, port, port_filename, unix_socket,
+                                                   visa_addr, directory)
+    
+    async def open(self):
+        "Connects and opens the instrument on the server."
+        setup = ()
+        if self.priority != 'acquisition':
+            setup += ((proto.PRIORITY, bytes([proto.PRIORITIES[self.priority]])),)
+        if self.compression is not None and self.family != 'AF_UNIX':
+            setup += ((proto.COMPRESS, proto.COMPRESSION_PARAMS.pack(proto.COMPRESSION[self.compression],
+                                                                     self.compression_threshold)),)
+        self.server = server_connection(self.address, self.family, setup)
+        self.server.attach(self)
+        await self.server.ensure_connected()
+        await self.reopen()
+        return self
+    
+    async def reopen(self):
+        "Opens the instrument, also on a new connection after the old one broke."
+        status, self.resource_id, payload = await self.server.exchange(proto.OPEN, 0,
+                                                                       proto.encode(self.visa_addr))
+        if status == proto.STATUS_ERROR:
+            raise RuntimeError(proto.decode(payload))
+        for name, steps in self.macros.items(): # the server may have restarted
+            await self.server.exchange(proto.DEFINE_MACRO, self.resource_id, proto.pack_macro(name, steps))
+    
+    async def disconnect(self):
+        "Leaves the connection to the server (closed once no other client uses it)."
+        await self.server.detach(self)
+    
+    async def __aenter__(self):
+        return await self.open()
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            await self.close()
+        finally:
+            await self.disconnect()
+    
+    async def request(self, opcode, payload=b''):
+        """
+        Sends one request and waits for its reply. A request failing because the
+        connection broke is sent once more on a new connection.
+
+        Returns
+        -------
+        memoryview
+            The reply payload.
+        """
+        if self.request_timeout is not None and opcode in proto.DEADLINE_TASKS:
+            opcode, payload = proto.with_deadline(opcode, payload, self.request_timeout)
+        try:
+            status, payload = await self.exchange(opcode, payload)
+        except ConnectionError:
+            status, payload = await self.exchange(opcode, payload)
+        if status == proto.STATUS_ERROR:
+            raise RuntimeError(proto.decode(payload))
+        if status == proto.STATUS_TIMEOUT:
+            raise TimeoutError(proto.decode(payload))
+        if status == proto.STATUS_COMPRESSED:
+            payload = proto.decompress(proto.COMPRESSION[self.compression], payload)
+        return payload
+    
+    async def exchange(self, opcode, payload):
+        await self.server.ensure_connected() # may reopen with a new resource id
+        status, _, payload = await self.server.exchange(opcode, self.resource_id, payload)
+        return status, payload
+    
+    async def close(self):
+        await self.request(proto.CLOSE)
+    
+    async def write(self, msg):
+        await self.request(proto.WRITE, proto.encode(msg))
+    
+    async def read(self):
+        return proto.decode(await self.request(proto.READ))
+    
+    async def query(self, msg):
+        return proto.decode(await self.request(proto.QUERY, proto.encode(msg)))
+    
+    async def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list,
+                                  header_fmt='ieee', expect_termination=True, data_points=0):
+        "Same as InstrumentClient.query_binary_values."
+        payload = proto.pack_binary_query(message, datatype, is_big_endian, header_fmt,
+                                          expect_termination, data_points)
+        data = await self.request(proto.QUERY_BINARY, payload)
+        dtype = np.dtype(proto.NUMPY_TYPES.get(datatype, datatype))
+        values = np.frombuffer(data, dtype=dtype.newbyteorder('>' if is_big_endian else '<'))
+        if container is np.ndarray:
+            return values
+        if container is list:
+            return values.tolist()
+        return container(values)
+    
+    async def query_ascii_values(self, message, converter='f', separator=',', container=list):
+        "Same as InstrumentClient.query_ascii_values, the converter must be parsed by the server."
+        data = await self.request(proto.QUERY_ASCII, proto.pack_ascii_query(message, converter, separator))
+        values = np.frombuffer(data, dtype=proto.ASCII_TYPES[converter])
+        if container in (np.ndarray, np.array):
+            return values
+        if container is list:
+            return values.tolist()
+        return container(values)
+    
+    async def configure(self, conf):
+        "Configure the instrument with the attributes in the conf dictionary."
+        await self.request(proto.CONF, pickle.dumps(conf))
+    
+    async def get_timeout(self):
+        "Timeout of the VISA resource on the server in ms."
+        return pickle.loads(await self.request(proto.GETATTR, proto.encode('timeout')))
+    
+    async def batch(self, ops):
+        "Same as InstrumentClient.batch."
+        tasks = [task.upper() for task, _ in ops]
+        items = [(proto.OPCODES[task], proto.encode(msg)) for task, (_, msg) in zip(tasks, ops)]
+        payload = await self.request(proto.BATCH, proto.pack_items(items))
+        return proto.unpack_results(tasks, payload)
+    
+    async def define_macro(self, name, steps):
+        "Same as InstrumentClient.define_macro."
+        steps = [(task.upper(), template) for task, template in steps]
+        await self.request(proto.DEFINE_MACRO, proto.pack_macro(name, steps))
+        self.macros[name] = steps
+    
+    async def run_macro(self, name, **params):
+        "Same as InstrumentClient.run_macro."
+        payload = await self.request(proto.RUN_MACRO, proto.pack_run_macro(name, params))
+        return proto.unpack_results([task for task, _ in self.macros[name]], payload)
+    
+    async def start_job(self, channels, points, poll, **kwargs):
+        "Same as InstrumentClient.start_job."
+        spec, dtype = job_request(channels, points, poll, **kwargs)
+        job_id, = proto.JOB.unpack(await self.request(proto.START_JOB, spec))
+        self.jobs[job_id] = dtype
+        return job_id
+    
+    async def fetch_job(self, job_id):
+        "Same as InstrumentClient.fetch_job."
+        try:
+            payload = await self.request(proto.FETCH_JOB, proto.JOB.pack(job_id))
+        except RuntimeError: # failed, the server forgot the job
+            self.jobs.pop(job_id, None)
+            raise
+        state, _, channels = proto.unpack_job_data(payload)
+        data = [np.frombuffer(channel, dtype=self.jobs[job_id]) for channel in channels]
+        done = state == proto.JOB_DONE
+        if done:
+            del self.jobs[job_id]
+        return done, data
+    
+    async def cancel_job(self, job_id):
+        "Same as InstrumentClient.cancel_job."
+        await self.request(proto.CANCEL_JOB, proto.JOB.pack(job_id))
+        self.jobs.pop(job_id, None)
+    
+    async def cache(self, msg, ttl=float('inf')):
+        "Same as InstrumentClient.cache."
+        await self.request(proto.CACHE, proto.SECONDS.pack(ttl) + proto.encode(msg))
+    
+    async def clear(self):
+        "VISA device clear on the server."
+        await self.request(proto.CLEAR)
@@ -32,6 +32,43 @@ class Instrument:
             for attr in conf:
                 setattr(self.dev, attr, conf[attr])
     
+    def sequence(self, name, steps, **params):
+        """
+        Executes a fixed sequence of commands. In socket mode it is registered
+        as a macro on the instrument server the first time and then run with
+        one request, atomically under the instrument's lock. Otherwise the
+        steps are executed one after another.
+
+        Parameters
+        ----------
+        name : string
+            Name of the sequence, unique for the instrument.
+        steps : list
+            (task, template) pairs, task is 'write', 'read' or 'query', the
+            template is formatted with params by str.format.
+
+        Returns
+        -------
+        list
+            The responses of the steps, None for writes.
+
+        """
+        if self.access_mode == 'socket' and self.dev.protocol == 'binary':
+            if self.dev.macros.get(name) is None:
+                self.dev.define_macro(name, steps)
+            return self.dev.run_macro(name, **params)
+        results = []
+        for task, template in steps:
+            match task.lower():
+                case 'write':
+                    self.dev.write(template.format(**params))
+                    results.append(None)
+                case 'read':
+                    results.append(self.dev.read())
+                case 'query':
+                    results.append(self.dev.query(template.format(**params)))
+        return results
+    
     def lock(self, timeout=5000):
         self.dev.lock(timeout=timeout)
         self.locked = True
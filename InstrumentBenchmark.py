@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:31:02 2026
+
+Load generator for the instrument server. Starts a server with simulated
+instruments (MockVISA) in a separate process and runs concurrent clients
+with a mixed read/write/query workload against it, then reports the request
+rate and latency percentiles. Run e.g.
+
+    python -m instruments.InstrumentBenchmark --clients 16 --instruments 4 --latency 0.001
+
+With --check-job it instead runs a binary acquisition job like
+SR830.buffer_job against the simulated instruments, whose binary queries
+follow pyvisa's semantics, and checks that all points arrive.
+"""
+
+import os
+import tempfile
+import time
+import random
+import argparse
+import asyncio
+import threading as thr
+import multiprocessing as mp
+from contextlib import contextmanager
+import numpy as np
+
+from . import InstrumentProtocol as proto
+from .InstrumentServer import VISAInstruments, InstrumentClientListener, AsyncInstrumentServer
+from .InstrumentClient import InstrumentClient
+from .MockVISA import MockResourceManager
+
+PORT_FILENAME = f'instrument_benchmark_port_{os.getpid()}.txt'
+
+def run_server(ready, use_asyncio, port_filename, latency, response_size):
+    "Server process: serves simulated instruments until terminated."
+    instruments = VISAInstruments(resource_manager=MockResourceManager(latency=latency,
+                                                                       response_size=response_size))
+    if use_asyncio:
+        server = AsyncInstrumentServer(instruments, port_filename=port_filename)
+        async def serve():
+            await server.start()
+            ready.set()
+            await server.server.serve_forever()
+        asyncio.run(serve())
+    else:
+        server = InstrumentClientListener(instruments, port_filename=port_filename)
+        server.start()
+        ready.set()
+        server.loop()
+
+def run_client(addr, mix, deadline, results, port_filename, protocol, share_connection, seed):
+    "Sends random requests until the deadline, appends (task, latency) to results."
+    client = InstrumentClient(addr, port_filename=port_filename, protocol=protocol,
+                              share_connection=share_connection)
+    rng = random.Random(seed)
+    tasks, weights = zip(*mix.items())
+    latencies = []
+    while time.perf_counter() < deadline:
+        task = rng.choices(tasks, weights)[0]
+        start = time.perf_counter()
+        match task:
+            case 'query':
+                client.query('MEAS?')
+            case 'write':
+                client.write('FREQ 1000')
+            case 'read':
+                client.read()
+        latencies.append((task, time.perf_counter() - start))
+    client.close()
+    client.disconnect()
+    results.extend(latencies)
+
+def parse_mix(text):
+    "'query=6,write=3,read=1' -> {'query': 6.0, 'write': 3.0, 'read': 1.0}"
+    mix = {}
+    for item in text.split(','):
+        task, weight = item.split('=')
+        if task not in ('query', 'write', 'read'):
+            raise ValueError(f"Unknown task {task}")
+        mix[task] = float(weight)
+    return mix
+
+def summarize(latencies, duration):
+    "Request rate and latency percentiles in ms, overall and per task."
+    def row(values):
+        values = np.array(values)*1e3
+        return {'requests': len(values),
+                'rate': len(values)/duration,
+                'p50': np.percentile(values, 50),
+                'p99': np.percentile(values, 99)}
+    rows = {'all': row([latency for _, latency in latencies])}
+    for task in sorted({task for task, _ in latencies}):
+        rows[task] = row([latency for t, latency in latencies if t == task])
+    return rows
+
+def benchmark(clients=8, instruments=4, duration=5.0, mix=None, latency=0.0, response_size=16,
+              use_asyncio=False, protocol='binary', share_connection=False):
+    """
+    Runs the benchmark.
+
+    Parameters
+    ----------
+    clients : int, optional
+        Number of concurrent clients (threads).
+    instruments : int, optional
+        Number of simulated instruments, the clients are spread over them.
+    duration : float, optional
+        Time in s the clients send requests.
+    mix : dict, optional
+        Relative weights of 'query', 'write' and 'read' requests.
+    latency : float, optional
+        Time in s every simulated command takes.
+    response_size : int, optional
+        Length of the simulated responses.
+    use_asyncio : bool, optional
+        Benchmark AsyncInstrumentServer instead of InstrumentClientListener.
+    protocol : str, optional
+        'binary' or 'string'.
+    share_connection : bool, optional
+        Let the clients share one connection (see InstrumentClient) instead
+        of one connection per client.
+
+    Returns
+    -------
+    dict
+        See summarize().
+    """
+    mix = mix or {'query': 6, 'write': 3, 'read': 1}
+    with server_process(use_asyncio, latency, response_size):
+        results = []
+        start = time.perf_counter()
+        deadline = start + duration
+        threads = [thr.Thread(target=run_client,
+                              args=(f'MOCK{k % instruments}::INSTR', mix, deadline, results,
+                                    PORT_FILENAME, protocol, share_connection, k))
+                   for k in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return summarize(results, time.perf_counter() - start)
+
+@contextmanager
+def server_process(use_asyncio=False, latency=0.0, response_size=16):
+    "Runs the server of run_server in a separate process for the duration of the with block."
+    ready = mp.Event()
+    server = mp.Process(target=run_server, args=(ready, use_asyncio, PORT_FILENAME, latency, response_size),
+                        daemon=True)
+    server.start()
+    try:
+        if not ready.wait(30):
+            raise RuntimeError("Benchmark server did not start")
+        yield
+    finally:
+        server.terminate()
+        server.join()
+        port_filename = os.path.join(tempfile.gettempdir(), PORT_FILENAME)
+        for path in (port_filename, proto.unix_socket_path(port_filename)):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+def check_job(points=10000, chunk=1024, use_asyncio=False):
+    """
+    Runs a two channel acquisition job with float32 binary replies, like
+    SR830.buffer_job, and raises RuntimeError unless all points arrive.
+
+    Returns
+    -------
+    float
+        Duration of the job in s.
+    """
+    with server_process(use_asyncio):
+        client = InstrumentClient('MOCK0::INSTR', port_filename=PORT_FILENAME)
+        try:
+            start = time.perf_counter()
+            job = client.start_job(['TRCB? 1,{start},{count}', 'TRCB? 2,{start},{count}'], points, 'SPTS?',
+                                   interval=0.01, chunk=chunk, start=[('write', 'STRT')],
+                                   finish=[('write', 'PAUS')], datatype='f', header_fmt='empty')
+            channels = [[], []]
+            done = False
+            while not done:
+                time.sleep(0.01)
+                done, data = client.fetch_job(job)
+                for values, new in zip(channels, data):
+                    values.append(new)
+            duration = time.perf_counter() - start
+        finally:
+            client.close()
+            client.disconnect()
+    for values in channels:
+        values = np.concatenate(values)
+        if len(values) != points or values.dtype != np.float32:
+            raise RuntimeError(f"Job returned {len(values)} {values.dtype} points instead of {points} float32")
+    return duration
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Instrument server load generator")
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--instruments', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0, help="in s")
+    parser.add_argument('--mix', type=parse_mix, default='query=6,write=3,read=1',
+                        help="relative weights of the requests")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated time per command in s")
+    parser.add_argument('--response-size', type=int, default=16)
+    parser.add_argument('--asyncio', action='store_true', help="benchmark AsyncInstrumentServer")
+    parser.add_argument('--protocol', choices=('binary', 'string'), default='binary')
+    parser.add_argument('--shared', action='store_true', help="all clients share one connection")
+    parser.add_argument('--check-job', action='store_true',
+                        help="check a binary acquisition job instead of benchmarking")
+    args = parser.parse_args()
+    if args.check_job:
+        print(f"Job of 10000 points done in {check_job(use_asyncio=args.asyncio):.3f} s")
+        raise SystemExit
+    rows = benchmark(args.clients, args.instruments, args.duration, args.mix, args.latency,
+                     args.response_size, args.asyncio, args.protocol, args.shared)
+    print(f"{'':8}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, row in rows.items():
+        print(f"{name:8}{row['requests']:>10}{row['rate']:>10.0f}{row['p50']:>10.3f}{row['p99']:>10.3f}")
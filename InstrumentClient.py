@@ -12,29 +12,450 @@ import os
 import tempfile
 import logging as log
 import pickle
+import json
+import threading as thr
+import weakref
+import socket
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from . import InstrumentProtocol as proto
+from . import InstrumentDirectory
+
+LOCAL_ADDRESSES = ('localhost', '127.0.0.1', '::1')
+
+class ServerConnection:
+    """
+    One persistent binary protocol connection to the instrument server, shared
+    by all InstrumentClients of the process which talk to the same server with
+    the same connection settings (see server_connection()). Frames carry the
+    resource id, so any number of instruments can use the connection.
+    
+    Requests of several threads are pipelined. Each thread sends its request and
+    waits for the reply with its request id, whichever waiting thread currently
+    receives hands the other replies to their requesters and queues published
+    frames by subscription id.
+    
+    When the connection breaks it is re-established, the connection settings
+    are sent again and the attached clients reopen their instruments. Locks and
+    subscriptions held on the server do not survive this.
+    """
+    def __init__(self, address, family=None, setup=()):
+        self.address = address
+        self.family = family
+        self.setup = setup # (opcode, payload) requests sent on every new connection
+        self.cond = thr.Condition(thr.Lock())
+        self.send_lock = thr.Lock()
+        self.reconnect_lock = thr.Lock()
+        self.connection = None
+        self.generation = 0 # number of the current connection
+        self.broken = False
+        self.receiving = False # a thread is receiving for everyone
+        self.request_id = 0
+        self.replies = {} # request id -> (status, resource id, payload)
+        self.waiting = set() # request ids of requests waiting for their reply
+        self.published = {} # subscription id -> deque of (status, payload)
+        self.clients = weakref.WeakSet()
+        self.connect()
+    
+    def connect(self):
+        connection = Client(self.address, family=self.family)
+        with self.cond:
+            self.connection = connection
+            self.generation += 1
+            self.broken = False
+            self.replies.clear()
+            self.published.clear()
+            self.cond.notify_all()
+        for opcode, payload in self.setup:
+            self.request(opcode, 0, payload)
+    
+    def reconnect(self, generation):
+        "Replaces the connection, unless another thread already did since generation."
+        with self.reconnect_lock:
+            if self.generation != generation:
+                return
+            log.warning(f"Reconnecting to the instrument server at {self.address}")
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+            self.connect()
+            for client in list(self.clients):
+                client.reopen(self)
+    
+    def attach(self, client):
+        self.clients.add(client)
+    
+    def detach(self, client):
+        "Removes the client, the connection is closed once no client uses it."
+        self.clients.discard(client)
+        if not self.clients:
+            release_connection(self)
+            self.connection.close()
+    
+    def request(self, opcode, resource_id, payload=b''):
+        """
+        Sends one request and waits for its reply.
+
+        Returns
+        -------
+        tuple
+            (status, resource_id, payload) of the reply.
+
+        Raises
+        ------
+        ConnectionError
+            If the connection broke, call reconnect() with the returned
+            generation and retry.
+        """
+        with self.cond:
+            self.request_id = (self.request_id + 1) & proto.MAX_REQUEST_ID
+            request_id = self.request_id
+            generation = self.generation
+            connection = self.connection
+            self.waiting.add(request_id)
+        try:
+            try:
+                with self.send_lock:
+                    connection.send_bytes(proto.pack_frame(opcode, resource_id, request_id, payload))
+            except OSError:
+                with self.cond:
+                    if generation == self.generation:
+                        self.broken = True
+                raise ConnectionError("Connection to the instrument server lost", generation)
+            return self.wait_for(lambda: self.replies.pop(request_id, None), generation)
+        finally:
+            with self.cond:
+                self.waiting.discard(request_id)
+    
+    def next_published(self, subscriptions, timeout=None):
+        "Next published (sub_id, status, payload) for any of subscriptions, None on timeout."
+        def ready():
+            for sub_id in subscriptions:
+                queue = self.published.get(sub_id)
+                if queue:
+                    return (sub_id,) + queue.popleft()
+            return None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return self.wait_for(ready, self.generation, deadline)
+    
+    def wait_for(self, ready, generation, deadline=None):
+        """
+        Receives frames until ready() (called with the condition held) returns
+        anything but None. Only one thread receives at a time, the others
+        wait for it to deliver their frames.
+        """
+        with self.cond:
+            while True:
+                result = ready()
+                if result is not None:
+                    return result
+                if self.broken or self.generation != generation:
+                    raise ConnectionError("Connection to the instrument server lost", generation)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                if self.receiving:
+                    self.cond.wait(remaining)
+                    continue
+                self.receiving = True
+                connection = self.connection
+                self.cond.release()
+                try:
+                    data = connection.recv_bytes() if connection.poll(remaining) else None
+                except (OSError, EOFError):
+                    data = None
+                    if generation == self.generation:
+                        self.broken = True
+                finally:
+                    self.cond.acquire()
+                    self.receiving = False
+                    self.cond.notify_all()
+                if data is not None:
+                    self.deliver(data)
+    
+    def deliver(self, data):
+        "Files a received frame for its recipient, called with the condition held."
+        status, resource_id, request_id, payload = proto.unpack_frame(data)
+        if status in (proto.STATUS_PUBLISH, proto.STATUS_PUBLISH_ERROR):
+            if request_id not in self.published: # updates not fetched in time are dropped, the oldest first
+                self.published[request_id] = deque(maxlen=proto.PUBLISH_BACKLOG)
+            self.published[request_id].append((status, payload))
+        elif request_id in self.waiting:
+            self.replies[request_id] = (status, resource_id, payload)
+        else:
+            log.warning(f"Discarding reply to unknown request {request_id}")
+    
+    def unsubscribed(self, sub_id):
+        with self.cond:
+            self.published.pop(sub_id, None)
+
+connections = {} # (address, family, setup) -> ServerConnection of this process
+connections_lock = thr.Lock()
+
+def server_connection(address, family=None, setup=()) -> ServerConnection:
+    "The process-wide connection to the server at address with the given settings."
+    key = (address, family, setup)
+    with connections_lock:
+        if key not in connections:
+            connections[key] = ServerConnection(address, family, setup)
+        return connections[key]
+
+def server_address(remote_address='localhost', port=None, port_filename='instrument_server_port.txt',
+                   unix_socket=True, visa_addr=None, directory=None):
+    """
+    Where to connect to the server, see InstrumentClient.
+
+    Returns
+    -------
+    tuple
+        (address, family) as taken by multiprocessing.connection.Client,
+        family is 'AF_UNIX' or None.
+    """
+    directory = directory or os.environ.get('INSTRUMENT_DIRECTORY')
+    port_filename = os.path.join(tempfile.gettempdir(), port_filename)
+    unix_path = None
+    if port is None and directory and visa_addr is not None:
+        remote_address, port = InstrumentDirectory.resolve(visa_addr, directory)
+        if is_local(remote_address) and os.path.exists(port_filename):
+            local_port, _, local_unix_path = proto.read_port_file(port_filename)
+            if local_port == port: # the owning server runs on this host
+                remote_address, unix_path = 'localhost', local_unix_path
+    elif port is None:
+        port, _, unix_path = proto.read_port_file(port_filename)
+    if unix_socket and unix_path and is_local(remote_address) and os.path.exists(unix_path):
+        return unix_path, 'AF_UNIX'
+    return (remote_address, port), None
+
+def is_local(host):
+    return host in LOCAL_ADDRESSES or host in (socket.gethostname(), socket.getfqdn())
+
+def job_request(channels, points, poll, interval=1.0, chunk=1024, start=(), finish=(),
+                datatype='f', is_big_endian=False, header_fmt='ieee', ascii=False):
+    """
+    START_JOB payload and numpy dtype of the job's data, see
+    InstrumentClient.start_job.
+    """
+    spec = {'channels': list(channels), 'points': points, 'poll': poll, 'interval': interval,
+            'chunk': chunk, 'start': [(task.upper(), cmd) for task, cmd in start],
+            'finish': [(task.upper(), cmd) for task, cmd in finish],
+            'binary': None if ascii else {'datatype': datatype, 'is_big_endian': is_big_endian,
+                                          'header_fmt': header_fmt, 'expect_termination': True}}
+    if ascii:
+        dtype = np.dtype('<f8')
+    else:
+        dtype = np.dtype(proto.NUMPY_TYPES.get(datatype, datatype)).newbyteorder('>' if is_big_endian else '<')
+    return proto.encode(json.dumps(spec)), dtype
+
+def release_connection(connection):
+    with connections_lock:
+        key = (connection.address, connection.family, connection.setup)
+        if connections.get(key) is connection:
+            del connections[key]
 
 class InstrumentClient:
-    def __init__(self, visa_addr, remote_address='localhost', port=None, port_filename='instrument_server_port.txt'):
+    """
+    Client side of the instrument server, a drop-in replacement for a pyvisa resource.
+    
+    By default the compact binary protocol from InstrumentProtocol is used,
+    protocol='string' selects the legacy space-separated string messages.
+    
+    With shared_memory=True (binary protocol, ignored for servers on other hosts)
+    replies of at least shm_threshold bytes are passed through shared memory
+    segments instead of the socket, and query_binary_values with
+    container=np.ndarray maps them without copying.
+    
+    The priority ('interactive', 'acquisition' or 'background') decides the
+    order in which the server serves waiting requests of different clients
+    to the same instrument.
+    
+    Clients on the server's host connect through its AF_UNIX socket (found in
+    the port file) instead of TCP, unless unix_socket=False.
+    
+    With compression='zlib' (or 'lz4', if installed) replies of at least
+    compression_threshold bytes are compressed by the server, which pays off
+    for large ASCII replies over slow networks. Not used over the AF_UNIX
+    socket.
+    
+    With a request_timeout (in s, binary protocol) the server drops requests
+    which could not get to the instrument within that time, e.g. because
+    another client holds it, and they raise TimeoutError instead of being
+    executed late. Opening, closing and unlocking are never dropped.
+    
+    With a directory ('host:port' of an InstrumentDirectory, by default the
+    INSTRUMENT_DIRECTORY environment variable) and no port the server owning
+    visa_addr is looked up there, so instruments may be spread over several
+    hosts. Resolutions are cached per process.
+    
+    With the binary protocol all clients of a process share one persistent
+    connection per server and settings (see ServerConnection), which is
+    re-established automatically when it breaks. Only a client holding a lock
+    uses a connection of its own, because the server leases the instrument
+    to a connection. It is kept for later locks until close() or
+    disconnect(). With share_connection=False the client always has its own.
+    """
+    def __init__(self, visa_addr, remote_address='localhost', port=None, port_filename='instrument_server_port.txt',
+                 protocol='binary', shared_memory=False, shm_threshold=1 << 16, priority='acquisition',
+                 unix_socket=True, share_connection=True, directory=None, compression=None,
+                 compression_threshold=1 << 12, request_timeout=None):
         self.visa_addr = visa_addr
+        if protocol not in ('binary', 'string'):
+            raise ValueError(f"Unknown protocol {protocol}")
+        if compression is not None and not proto.compression_available(proto.COMPRESSION.get(compression)):
+            raise ValueError(f"Compression {compression} not available")
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.request_timeout = request_timeout
+        self.protocol = protocol
+        self.resource_id = 0 # assigned by the server in open()
+        self.request_id = 0
+        self.shm_threshold = shm_threshold
+        self.priority = priority
+        self.segments = {} # name -> mapped shared memory segment
+        self.subscriptions = set()
+        self.macros = {} # name -> steps of the macros defined by this client
+        self.jobs = {} # job id -> dtype of the job's data
 
-        if port is None:
-            with open(os.path.join(tempfile.gettempdir(), port_filename), 'r') as port_file:
-                port = int(port_file.readline())
-        self.address = (remote_address, port)
-        self.connection = Client(self.address) #open conncetion to the server
-        self.open() #open the instrument on the server
+        self.address, self.family = server_address(remote_address, port, port_filename, unix_socket,
+                                                   visa_addr, directory)
+        # segments can only be mapped on the server's host
+        self.shared_memory = (shared_memory and protocol == 'binary'
+                              and (self.family == 'AF_UNIX' or is_local(self.address[0])))
+        self.private = None # own connection for locks, kept for the next lock
+        self.locked = False # requests go through private
+        self.share_connection = share_connection
+        try:
+            if protocol == 'binary':
+                self.private_setup = self.connect()
+            else: # no request ids in the legacy protocol, so no sharing of the connection
+                self.connection = Client(self.address, family=self.family) #open conncetion to the server
+            self.open() #open the instrument on the server
+        except OSError:
+            if port is None and (directory or os.environ.get('INSTRUMENT_DIRECTORY')):
+                InstrumentDirectory.forget(visa_addr, directory) # the instrument may have moved
+            raise
+    
+    def connect(self):
+        "Attaches to the process-wide connection to the server with this client's settings."
+        setup = []
+        if self.shared_memory:
+            setup.append((proto.SHARE, proto.THRESHOLD.pack(self.shm_threshold)))
+        if self.priority != 'acquisition':
+            setup.append((proto.PRIORITY, bytes([proto.PRIORITIES[self.priority]])))
+        if self.compression is not None and self.family != 'AF_UNIX':
+            setup.append((proto.COMPRESS, proto.COMPRESSION_PARAMS.pack(proto.COMPRESSION[self.compression],
+                                                                        self.compression_threshold)))
+        if self.share_connection:
+            self.server = server_connection(self.address, self.family, tuple(setup))
+        else:
+            self.server = ServerConnection(self.address, self.family, tuple(setup))
+        self.server.attach(self)
+        return tuple(setup)
     
     def disconnect(self):
-        "Close the connection to the server."
-        self.connection.close()
+        "Close the connection to the server (the shared one once no other client uses it)."
+        if self.protocol == 'binary':
+            for sub_id in list(self.subscriptions):
+                self.unsubscribe(sub_id)
+            self.release_segments()
+            self.close_segments()
+            self.drop_private()
+            self.server.detach(self)
+        else:
+            self.close_segments()
+            self.connection.close()
+    
+    def drop_private(self):
+        "Closes the connection used for locks, with its reference to the instrument."
+        self.locked = False
+        if self.private is not None:
+            private, self.private = self.private, None
+            self.close_on(private)
+            private.detach(self)
+    
+    def close_on(self, server):
+        "Drops the reference to the instrument held by the connection server, which is about to be left."
+        try:
+            self.request(proto.CLOSE, server=server)
+        except (RuntimeError, ConnectionError, OSError) as e:
+            log.warning(f"Closing {self.visa_addr} on a connection being left failed: {e}")
     
     def send_and_recv(self, msg):
-        log.debug(f'{self.visa_addr} sending {msg}')
+        log.debug('%s sending %s', self.visa_addr, msg)
         self.connection.send(msg)
         resp = self.connection.recv()
-        log.debug(f'{self.visa_addr} recvd {resp}')
+        log.debug('%s recvd %s', self.visa_addr, resp)
         return resp
     
+    def request(self, opcode, payload=b'', server=None):
+        """
+        Sends one binary request and waits for its reply. A broken connection
+        is re-established and the request sent once more.
+        
+        Requests go through the private connection while the client holds a
+        lock, otherwise (or if server is given) through the shared one.
+
+        Returns
+        -------
+        tuple
+            (resource_id, payload) of the reply.
+        """
+        if self.segments and opcode != proto.RELEASE:
+            self.release_segments()
+        if self.request_timeout is not None and opcode in proto.DEADLINE_TASKS:
+            opcode, payload = proto.with_deadline(opcode, payload, self.request_timeout)
+        server = server or (self.private if self.locked else self.server)
+        try:
+            status, resource_id, payload = server.request(opcode, self.resource_id, payload)
+        except ConnectionError as e:
+            server.reconnect(e.args[1])
+            status, resource_id, payload = server.request(opcode, self.resource_id, payload)
+        if status == proto.STATUS_ERROR:
+            raise RuntimeError(proto.decode(payload))
+        if status == proto.STATUS_TIMEOUT:
+            raise TimeoutError(proto.decode(payload))
+        if status == proto.STATUS_SHARED:
+            payload = self.map_segment(payload)
+        elif status == proto.STATUS_COMPRESSED:
+            payload = proto.decompress(proto.COMPRESSION[self.compression], payload)
+        return resource_id, payload
+    
+    def map_segment(self, descriptor):
+        """
+        Maps the shared memory segment described by descriptor and returns a
+        memoryview of the payload. The segment is handed back to the server
+        once nothing (e.g. an array made from the memoryview) uses it anymore.
+        """
+        size, = proto.SHARED_DESCRIPTOR.unpack_from(descriptor)
+        name = proto.decode(descriptor[proto.SHARED_DESCRIPTOR.size:])
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix': # the server unlinks the segment, not our resource tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        self.segments[name] = shm
+        return shm.buf[:size]
+    
+    def release_segments(self):
+        "Unmaps the segments that are no longer in use and releases them to the server."
+        released = []
+        for name, shm in list(self.segments.items()):
+            try:
+                shm.close()
+            except BufferError: # still exported to an array
+                continue
+            released.append(name)
+            del self.segments[name]
+        if released:
+            self.request(proto.RELEASE, proto.encode('\n'.join(released)))
+    
+    def close_segments(self):
+        for shm in self.segments.values():
+            try:
+                shm.close()
+            except BufferError: # still used by an array, unmapped when the array is collected
+                pass
+        self.segments = {}
+    
     @staticmethod
     def handle_error(msg):
         toks = msg.split(' ')
@@ -43,20 +464,46 @@ class InstrumentClient:
         else:
             raise RuntimeError(f"Unknown Error: {msg}")
     
-    def open(self):
-        "Open the instrument on the server."
+    def open(self, server=None):
+        """
+        Open the instrument on the server. The server counts the references
+        per connection, so every connection the client uses opens it.
+        """
+        if self.protocol == 'binary':
+            self.resource_id, _ = self.request(proto.OPEN, proto.encode(self.visa_addr), server)
+            return
         resp = self.send_and_recv(f"OPEN {self.visa_addr}")
         if resp != "OPEN OK":
             self.handle_error(resp)
     
+    def reopen(self, server):
+        "Opens the instrument again after server reconnected, the server may have restarted."
+        self.segments = {} # mapped segments of the old connection are closed when unused
+        if server is self.server:
+            self.subscriptions.clear()
+        status, self.resource_id, payload = server.request(proto.OPEN, 0, proto.encode(self.visa_addr))
+        if status == proto.STATUS_ERROR:
+            log.error(f"Reopening {self.visa_addr} failed: {proto.decode(payload)}")
+            return
+        for name, steps in self.macros.items():
+            server.request(proto.DEFINE_MACRO, self.resource_id, proto.pack_macro(name, steps))
+    
     def close(self):
+        if self.protocol == 'binary':
+            if self.locked:
+                self.unlock()
+            self.request(proto.CLOSE, server=self.server)
+            self.drop_private()
+            return
         resp = self.send_and_recv(f"CLOSE {self.visa_addr}")
         if resp != "CLOSE OK":
             self.handle_error(resp)
     
     def read(self):
+        if self.protocol == 'binary':
+            _, payload = self.request(proto.READ)
+            return proto.decode(payload)
         resp = self.send_and_recv(f'READ {self.visa_addr}')
-        self.disconnect()
         toks = resp.split(' ')
         if toks[0] == 'READ':
             return ' '.join(toks[1:])
@@ -64,11 +511,17 @@ class InstrumentClient:
             self.handle_error(resp)            
     
     def write(self, msg):
+        if self.protocol == 'binary':
+            self.request(proto.WRITE, proto.encode(msg))
+            return
         resp = self.send_and_recv(f'WRITE {self.visa_addr} {msg}')
         if resp != "WRITE OK":
             self.handle_error(resp)
     
     def query(self, msg):
+        if self.protocol == 'binary':
+            _, payload = self.request(proto.QUERY, proto.encode(msg))
+            return proto.decode(payload)
         resp = self.send_and_recv(f'QUERY {self.visa_addr} {msg}')
         toks = resp.split(' ')
         if toks[0] == 'READ':
@@ -76,6 +529,334 @@ class InstrumentClient:
         else:
             self.handle_error(resp)
     
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list,
+                            header_fmt='ieee', expect_termination=True, data_points=0):
+        """
+        Same as pyvisa's query_binary_values. The server sends the raw block
+        data, which is decoded directly with numpy.frombuffer.
+
+        Returns
+        -------
+        container
+            The decoded values. For container=np.ndarray the array is a
+            read-only view of the received message, no copy is made.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Binary values require the binary protocol")
+        payload = proto.pack_binary_query(message, datatype, is_big_endian, header_fmt,
+                                          expect_termination, data_points)
+        _, data = self.request(proto.QUERY_BINARY, payload)
+        dtype = np.dtype(proto.NUMPY_TYPES.get(datatype, datatype))
+        values = np.frombuffer(data, dtype=dtype.newbyteorder('>' if is_big_endian else '<'))
+        if container is np.ndarray:
+            return values
+        if container is list:
+            return values.tolist()
+        return container(values)
+    
+    def query_ascii_values(self, message, converter='f', separator=',', container=list):
+        """
+        Same as pyvisa's query_ascii_values. With the binary protocol the
+        server parses the numbers (converters 'f', 'e', 'g', 'd' and 'i') and
+        sends them as a packed array, which is smaller than the text and
+        saves the parsing here. Other converters, e.g. callables, are applied
+        to the response locally.
+
+        Returns
+        -------
+        container
+            The values. For container=np.ndarray (or np.array) the array is a
+            read-only view of the received message.
+
+        """
+        if (self.protocol != 'binary' or not isinstance(converter, str)
+                or converter not in proto.ASCII_TYPES or len(separator) != 1):
+            if isinstance(converter, str):
+                converter = {'f': float, 'e': float, 'g': float, 'd': int, 'i': int, 's': str}[converter]
+            values = [converter(value) for value in self.query(message).strip().split(separator) if value]
+            return np.array(values) if container in (np.ndarray, np.array) else container(values)
+        _, data = self.request(proto.QUERY_ASCII, proto.pack_ascii_query(message, converter, separator))
+        values = np.frombuffer(data, dtype=proto.ASCII_TYPES[converter])
+        if container in (np.ndarray, np.array):
+            return values
+        if container is list:
+            return values.tolist()
+        return container(values)
+    
+    def set_priority(self, priority):
+        """
+        Sets the priority class ('interactive', 'acquisition' or 'background') of
+        further requests. The priority belongs to the connection, so the client
+        moves to the shared connection with that priority.
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Priorities require the binary protocol")
+        if priority not in proto.PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}")
+        if priority == self.priority:
+            return
+        if self.subscriptions:
+            raise RuntimeError("Cancel the subscriptions before changing the priority")
+        if self.locked:
+            self.request(proto.PRIORITY, bytes([proto.PRIORITIES[priority]]))
+        else: # made again with the new priority by the next lock
+            self.drop_private()
+        self.release_segments()
+        old_server = self.server
+        self.priority = priority
+        self.private_setup = self.connect()
+        self.open(self.server)
+        self.close_on(old_server)
+        old_server.detach(self)
+    
+    def stats(self):
+        """
+        Server statistics: per-instrument and per-command latencies, lock wait
+        times, queue depths and bytes transferred.
+
+        Returns
+        -------
+        dict
+            See InstrumentStats.ServerStats.snapshot.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Statistics require the binary protocol")
+        _, payload = self.request(proto.STATS)
+        return json.loads(proto.decode(payload))
+    
+    def cache(self, msg, ttl=float('inf')):
+        """
+        Lets the server cache the responses to the query msg for ttl seconds,
+        shared by all clients of this instrument. Any write to the instrument
+        invalidates the cache. A ttl of zero disables caching of msg again.
+
+        Parameters
+        ----------
+        msg : string
+            The query, exactly as it is passed to query().
+        ttl : float, optional
+            Time to live of the cached responses in s. The default never
+            expires, which is meant for constant responses such as *IDN?.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Caching requires the binary protocol")
+        self.request(proto.CACHE, proto.SECONDS.pack(ttl) + proto.encode(msg))
+    
+    def subscribe(self, msg, interval):
+        """
+        Subscribes to the responses to the query msg, which the server polls
+        every interval seconds and pushes to all its subscribers. Use
+        next_update() to receive them.
+
+        Returns
+        -------
+        int
+            The subscription id.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Subscriptions require the binary protocol")
+        _, payload = self.request(proto.SUBSCRIBE, proto.SECONDS.pack(interval) + proto.encode(msg),
+                                  self.server)
+        sub_id, = proto.SUBSCRIPTION.unpack(payload)
+        self.subscriptions.add(sub_id)
+        return sub_id
+    
+    def unsubscribe(self, sub_id):
+        self.subscriptions.discard(sub_id)
+        self.request(proto.UNSUBSCRIBE, proto.SUBSCRIPTION.pack(sub_id), self.server)
+        self.server.unsubscribed(sub_id)
+    
+    def next_update(self, timeout=None):
+        """
+        Waits for the next update published to any subscription of this client.
+
+        Parameters
+        ----------
+        timeout : float or None, optional
+            Maximum time to wait in s, None waits indefinitely.
+
+        Returns
+        -------
+        tuple or None
+            (subscription id, timestamp, response), or None on timeout. The
+            timestamp is the server's time.time() of the poll.
+
+        """
+        try:
+            published = self.server.next_published(self.subscriptions, timeout)
+        except ConnectionError as e: # the subscriptions are gone with the connection
+            self.server.reconnect(e.args[1])
+            raise RuntimeError("Connection to the instrument server lost, subscriptions cancelled")
+        if published is None:
+            return None
+        sub_id, status, payload = published
+        timestamp, = proto.TIMESTAMP.unpack_from(payload)
+        resp = proto.decode(payload[proto.TIMESTAMP.size:])
+        if status == proto.STATUS_PUBLISH_ERROR:
+            raise RuntimeError(resp)
+        return sub_id, timestamp, resp
+    
+    @property
+    def timeout(self):
+        "Timeout of the VISA resource on the server in ms, like pyvisa's Resource.timeout."
+        if self.protocol != 'binary':
+            raise RuntimeError("Reading attributes requires the binary protocol")
+        _, payload = self.request(proto.GETATTR, proto.encode('timeout'))
+        return pickle.loads(payload)
+    
+    @timeout.setter
+    def timeout(self, value):
+        self.configure({'timeout': value})
+    
+    def batch(self, ops):
+        """
+        Sends several operations in one message. The server executes them in
+        order under a single lock acquisition and returns all replies together.
+
+        Parameters
+        ----------
+        ops : list
+            (task, msg) pairs, task is 'write', 'read' or 'query'. The msg is
+            ignored for 'read'.
+
+        Returns
+        -------
+        list
+            The responses in the order of ops, None for writes.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Batches require the binary protocol")
+        tasks = [task.upper() for task, _ in ops]
+        items = [(proto.OPCODES[task], proto.encode(msg)) for task, (_, msg) in zip(tasks, ops)]
+        _, payload = self.request(proto.BATCH, proto.pack_items(items))
+        return proto.unpack_results(tasks, payload)
+    
+    def define_macro(self, name, steps):
+        """
+        Registers a named command sequence for this instrument on the server,
+        to be executed with run_macro().
+
+        Parameters
+        ----------
+        name : string
+            Name of the macro, shared with the other clients of the instrument.
+        steps : list
+            (task, template) pairs, task is 'write', 'read' or 'query' and the
+            template is formatted with the keyword arguments of run_macro(),
+            e.g. ('write', 'ADEP {depth:.1f}').
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Macros require the binary protocol")
+        steps = [(task.upper(), template) for task, template in steps]
+        self.request(proto.DEFINE_MACRO, proto.pack_macro(name, steps))
+        self.macros[name] = steps
+    
+    def run_macro(self, name, **params):
+        """
+        Executes the macro name with one request, atomically under the
+        instrument's lock like batch().
+
+        Returns
+        -------
+        list
+            The responses of the steps, None for writes.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Macros require the binary protocol")
+        _, payload = self.request(proto.RUN_MACRO, proto.pack_run_macro(name, params))
+        return proto.unpack_results([task for task, _ in self.macros[name]], payload)
+    
+    def start_job(self, channels, points, poll, interval=1.0, chunk=1024, start=(), finish=(),
+                  datatype='f', is_big_endian=False, header_fmt='ieee', ascii=False):
+        """
+        Starts an acquisition job driven by the server (see
+        InstrumentServer.AcquisitionJob). The server polls the instrument and
+        fetches the data in chunks while requests of other clients go on, the
+        client collects the data with fetch_job() whenever convenient.
+
+        Parameters
+        ----------
+        channels : list
+            Query templates fetching the points of every channel, formatted
+            with start (index of the first point) and count, e.g.
+            'TRCB? 1,{start},{count}'.
+        points : int
+            Number of points to acquire.
+        poll : string
+            Query answering the number of points acquired by the instrument.
+        interval : float, optional
+            Polling interval in s.
+        chunk : int, optional
+            Maximum number of points fetched at once.
+        start, finish : list, optional
+            (task, cmd) pairs executed as a batch before the acquisition and
+            after it.
+        datatype, is_big_endian, header_fmt : optional
+            Binary format of the channel replies, see query_binary_values.
+        ascii : bool, optional
+            The channel replies are comma separated ASCII values instead,
+            the server converts them to float64.
+
+        Returns
+        -------
+        int
+            The job id.
+
+        """
+        if self.protocol != 'binary':
+            raise RuntimeError("Jobs require the binary protocol")
+        spec, dtype = job_request(channels, points, poll, interval, chunk, start, finish,
+                                  datatype, is_big_endian, header_fmt, ascii)
+        _, payload = self.request(proto.START_JOB, spec)
+        job_id, = proto.JOB.unpack(payload)
+        self.jobs[job_id] = dtype
+        return job_id
+    
+    def fetch_job(self, job_id):
+        """
+        Data acquired by the job since the last fetch. Raises RuntimeError if
+        the job failed.
+
+        Returns
+        -------
+        done : bool
+            True once the job ended and all its data were fetched.
+        data : list
+            numpy arrays of the new points of every channel.
+
+        """
+        try:
+            _, payload = self.request(proto.FETCH_JOB, proto.JOB.pack(job_id))
+        except RuntimeError: # failed, the server forgot the job
+            self.jobs.pop(job_id, None)
+            raise
+        state, _, channels = proto.unpack_job_data(payload)
+        data = [np.frombuffer(channel, dtype=self.jobs[job_id]) for channel in channels]
+        done = state == proto.JOB_DONE
+        if done:
+            del self.jobs[job_id]
+        return done, data
+    
+    def cancel_job(self, job_id):
+        "Stops the job, its data not fetched yet are discarded."
+        self.request(proto.CANCEL_JOB, proto.JOB.pack(job_id))
+        self.jobs.pop(job_id, None)
+    
     def configure(self, conf):
         """
         Configure the instrument with the options in the conf dictionary.
@@ -92,17 +873,64 @@ class InstrumentClient:
         None.
 
         """
+        if self.protocol == 'binary':
+            self.request(proto.CONF, pickle.dumps(conf))
+            return
         conf_msg = f"CONF {self.visa_addr} {pickle.dumps(conf).hex()}"
         resp = self.send_and_recv(conf_msg)
         if resp != "CONF OK":
            self.handle_error(resp)
     
-    def lock(self):
-        #TODO
-        pass
+    def lock(self, timeout=5000, lease=60000):
+        """
+        Locks the instrument for exclusive use by this client, other clients'
+        requests for it wait until unlock(). Unlike a VISA lock this is a lease
+        held by the server, released automatically after lease ms or when the
+        client disconnects.
+
+        Parameters
+        ----------
+        timeout : int or None, optional
+            Maximum time to wait for the lock of another client in ms, like
+            pyvisa's Resource.lock. None waits indefinitely.
+        lease : int, optional
+            Maximum time the lock is held in ms.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.protocol != 'binary': # no locking in the string protocol
+            return
+        # the lease must not extend to the other clients of the shared connection, so it is
+        # held by a connection of this client only, kept open for later locks
+        if self.private is None:
+            self.private = ServerConnection(self.address, self.family, self.private_setup)
+            self.private.attach(self)
+            try:
+                self.open(self.private)
+            except RuntimeError:
+                self.private.detach(self)
+                self.private = None
+                raise
+        if not self.locked:
+            self.release_segments()
+        timeout = -1 if timeout is None else timeout/1000
+        self.request(proto.LOCK, proto.LOCK_PARAMS.pack(timeout, lease/1000), server=self.private)
+        self.locked = True
+    
     def unlock(self):
-        #TODO
-        pass
+        if self.protocol != 'binary':
+            return
+        if self.private is None:
+            return
+        self.request(proto.UNLOCK, server=self.private)
+        self.release_segments()
+        self.locked = False
+    
     def clear(self):
-        #TODO
-        pass
\ No newline at end of file
+        "VISA device clear on the server."
+        if self.protocol != 'binary':
+            return
+        self.request(proto.CLEAR)
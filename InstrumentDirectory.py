@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:52:16 2026
+
+Directory of instrument servers on several hosts. Every instrument server
+registers the VISA addresses it serves (and re-registers periodically, so
+that servers which went away drop out), clients ask the directory which
+server owns an address and cache the answer. Instruments can thus be spread
+over the lab computers while scripts only name the VISA address:
+
+    python -m instruments.InstrumentDirectory                       # on one host
+    python InstrumentServer.py --directory labpc1:47300             # on every instrument host
+    InstrumentClient('GPIB0::12::INSTR', directory='labpc1:47300')  # or set INSTRUMENT_DIRECTORY
+
+Requests and replies are JSON objects sent as multiprocessing.connection
+messages.
+"""
+
+from multiprocessing.connection import Listener, Client
+import os
+import json
+import time
+import threading as thr
+import logging as log
+
+DEFAULT_PORT = 47300
+REGISTRATION_TTL = 30.0 # s a registration is valid without being renewed
+CACHE_TTL = 60.0 # s clients keep a resolved address
+
+class InstrumentDirectory:
+    """
+    The directory service, maps VISA addresses to the (host, port) of the
+    servers which registered them.
+    """
+    def __init__(self, address='', port=DEFAULT_PORT):
+        self.address = (address, port)
+        self.servers = {} # (host, port) -> (expiry, VISA addresses)
+        self.lock = thr.Lock()
+    
+    def register(self, host, port, addresses, ttl=REGISTRATION_TTL):
+        with self.lock:
+            if (host, port) not in self.servers:
+                log.info(f"Registered {host}:{port} with {len(addresses)} instruments")
+            self.servers[host, port] = (time.monotonic() + ttl, tuple(addresses))
+    
+    def unregister(self, host, port):
+        with self.lock:
+            self.servers.pop((host, port), None)
+        log.info(f"Unregistered {host}:{port}")
+    
+    def live_servers(self):
+        "Registered servers which have not expired, dropping the expired ones."
+        now = time.monotonic()
+        with self.lock:
+            for server in [s for s, (expiry, _) in self.servers.items() if expiry < now]:
+                log.info(f"Registration of {server[0]}:{server[1]} expired")
+                del self.servers[server]
+            return {server: addresses for server, (_, addresses) in self.servers.items()}
+    
+    def resolve(self, addr):
+        """
+        The server of the VISA address addr.
+    
+        Returns
+        -------
+        tuple
+            (host, port) of the server.
+    
+        Raises
+        ------
+        KeyError
+            If no server or more than one serves addr.
+        """
+        owners = [server for server, addresses in self.live_servers().items() if addr in addresses]
+        if not owners:
+            raise KeyError(f"No server for {addr}")
+        if len(owners) > 1:
+            raise KeyError(f"{addr} is served by several servers: "
+                           + ", ".join(f"{host}:{port}" for host, port in owners)
+                           + ", pass remote_address and port to choose one")
+        return owners[0]
+    
+    def handle(self, request: dict) -> dict:
+        try:
+            match request.get('op'):
+                case 'register':
+                    self.register(request['host'], request['port'], request['addresses'],
+                                  request.get('ttl', REGISTRATION_TTL))
+                    return {'ok': True}
+                case 'unregister':
+                    self.unregister(request['host'], request['port'])
+                    return {'ok': True}
+                case 'resolve':
+                    host, port = self.resolve(request['address'])
+                    return {'ok': True, 'host': host, 'port': port}
+                case 'list':
+                    servers = self.live_servers()
+                    return {'ok': True, 'servers': [{'host': host, 'port': port, 'addresses': addresses}
+                                                    for (host, port), addresses in servers.items()]}
+                case op:
+                    raise ValueError(f"Unknown directory request {op}")
+        except (KeyError, ValueError, TypeError) as e:
+            return {'ok': False, 'error': e.args[0] if e.args else str(e)}
+    
+    def serve_connection(self, conn):
+        with conn:
+            try:
+                while True:
+                    reply = self.handle(json.loads(conn.recv_bytes()))
+                    conn.send_bytes(json.dumps(reply).encode())
+            except (EOFError, OSError):
+                pass
+            except json.JSONDecodeError as e:
+                log.error(f"Bad directory request: {e}")
+    
+    def serve_forever(self):
+        with Listener(self.address) as listener:
+            log.info(f"Instrument directory listening on {listener.address}")
+            while True:
+                conn = listener.accept()
+                thr.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+class DirectoryRegistration(thr.Thread):
+    """
+    Keeps the registration of an instrument server in the directory alive,
+    renewing it every third of its time to live.
+    
+    Parameters
+    ----------
+    directory : str or tuple
+        The directory, 'host:port' or (host, port).
+    host : str
+        Name under which clients reach the server.
+    port_source : callable
+        Returns the TCP port of the server, blocks until it is known.
+    addresses : callable
+        Returns the VISA addresses served.
+    """
+    def __init__(self, directory, host, port_source, addresses, ttl=REGISTRATION_TTL):
+        super().__init__(name="directory registration", daemon=True)
+        self.directory = parse_directory(directory)
+        self.host = host
+        self.port_source = port_source
+        self.addresses = addresses
+        self.ttl = ttl
+        self.stop_event = thr.Event()
+    
+    def run(self):
+        port = self.port_source()
+        while True:
+            try:
+                ask(self.directory, {'op': 'register', 'host': self.host, 'port': port,
+                                     'addresses': list(self.addresses()), 'ttl': self.ttl})
+            except (OSError, RuntimeError) as e:
+                log.warning(f"Registration with the directory at {self.directory} failed: {e}")
+            if self.stop_event.wait(self.ttl/3):
+                break
+        try:
+            ask(self.directory, {'op': 'unregister', 'host': self.host, 'port': port})
+        except (OSError, RuntimeError):
+            pass
+    
+    def stop(self):
+        self.stop_event.set()
+
+def parse_directory(directory):
+    "'host:port' or 'host' or (host, port) -> (host, port)"
+    if isinstance(directory, str):
+        host, _, port = directory.partition(':')
+        return host, int(port) if port else DEFAULT_PORT
+    host, port = directory
+    return host, int(port)
+
+def ask(directory, request: dict) -> dict:
+    "Sends one request to the directory and returns its reply, raises RuntimeError for errors."
+    with Client(parse_directory(directory)) as conn:
+        conn.send_bytes(json.dumps(request).encode())
+        reply = json.loads(conn.recv_bytes())
+    if not reply.get('ok'):
+        raise RuntimeError(reply.get('error'))
+    return reply
+
+cache = {} # (directory, VISA address) -> (expiry, (host, port))
+cache_lock = thr.Lock()
+
+def resolve(addr, directory=None):
+    """
+    The (host, port) of the server of the VISA address addr, asked from the
+    directory (default: the INSTRUMENT_DIRECTORY environment variable) and
+    cached for CACHE_TTL seconds.
+    """
+    directory = parse_directory(directory or os.environ['INSTRUMENT_DIRECTORY'])
+    key = (directory, addr)
+    with cache_lock:
+        entry = cache.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    reply = ask(directory, {'op': 'resolve', 'address': addr})
+    server = (reply['host'], reply['port'])
+    with cache_lock:
+        cache[key] = (time.monotonic() + CACHE_TTL, server)
+    return server
+
+def forget(addr, directory=None):
+    "Drops the cached resolution of addr, e.g. after its server could not be reached."
+    directory = parse_directory(directory or os.environ['INSTRUMENT_DIRECTORY'])
+    with cache_lock:
+        cache.pop((directory, addr), None)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Directory of instrument servers")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    log.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=log.INFO)
+    try:
+        InstrumentDirectory(port=args.port).serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:40:12 2026
+
+Binary wire protocol shared by InstrumentServer and InstrumentClient.
+
+Every message is one multiprocessing.connection message (which already carries
+the length prefix) consisting of a fixed header followed by the raw payload:
+
+    magic (uint8) | opcode (uint8) | resource id (uint16) | request id (uint32) | payload
+
+Requests carry the task in the opcode, replies carry a status. The resource id
+is assigned by the server when the instrument is opened and replaces the VISA
+address in all subsequent requests. The magic byte can never start a pickle,
+so the server can tell binary frames from the legacy pickled string messages.
+
+A BATCH request carries several sub-requests for the same resource, each
+packed as opcode (uint8) | length (uint32) | payload. The reply packs the
+sub-replies the same way with the status in place of the opcode.
+
+A QUERY_BINARY request starts with the BINARY_PARAMS block (pyvisa datatype
+character, flags, header format, number of data points) followed by the query
+message. Its reply payload is the raw data of the binary block with the
+header stripped, ready for numpy.frombuffer.
+
+After a SHARE request (payload: size threshold, uint32) the server may answer
+with STATUS_SHARED instead of STATUS_OK. The payload is then only a descriptor
+(SHARED_DESCRIPTOR, size followed by the name) of a multiprocessing.shared_memory
+segment holding the real payload. Once the client no longer uses the data it
+sends a RELEASE request (payload: newline separated segment names) and the
+server may reuse the segments for later replies. The segments are unlinked by
+the server when the connection closes.
+
+A CACHE request (payload: time to live in s as SECONDS, followed by the query)
+enables the server-side caching of the responses to that query.
+
+A SUBSCRIBE request (payload: polling interval in s as SECONDS, followed by the
+query) is answered with a SUBSCRIPTION id. From then on the server pushes
+unsolicited STATUS_PUBLISH frames with the subscription id in place of the
+request id and the payload TIMESTAMP (time.time() of the poll) followed by the
+response, or STATUS_PUBLISH_ERROR frames with the error message instead.
+UNSUBSCRIBE (payload: SUBSCRIPTION) stops them.
+
+A PRIORITY request (payload: one byte, see PRIORITIES) sets the priority class
+of all further requests on the connection. Server-side polling for
+subscriptions runs in the BACKGROUND class.
+
+A LOCK request (payload: LOCK_PARAMS, the maximum time to wait in s, negative
+for no limit, and the lease duration in s) leases the resource exclusively to
+the connection until UNLOCK, until the lease expires or until the connection
+closes. Requests of other connections for the resource wait meanwhile.
+
+A STATS request is answered with the server statistics as JSON text.
+
+A DEFINE_MACRO request (payload: name, newline, then the steps packed like the
+sub-requests of a BATCH with str.format templates as payloads) registers a
+named command sequence for the resource. RUN_MACRO (payload: name, newline,
+the template parameters as a JSON object) executes it like a BATCH and gets
+the same reply.
+
+A START_JOB request (payload: the job specification as a JSON object, see
+InstrumentServer.AcquisitionJob) starts an acquisition driven by the server and
+is answered with a JOB id. FETCH_JOB (payload: JOB) is answered with JOB_STATE
+(state and number of points acquired so far) followed by the data acquired
+since the last fetch, the raw bytes of every channel packed like BATCH items
+with the channel index as code. A failed job is answered with STATUS_ERROR
+once its remaining data have been fetched. CANCEL_JOB (payload: JOB) stops and discards the job.
+
+A COMPRESS request (payload: COMPRESSION_PARAMS, the algorithm, see
+COMPRESSION, and a size threshold) makes the server compress reply payloads
+of at least threshold bytes on this connection, where that makes them smaller.
+Such replies have STATUS_COMPRESSED. zlib is always available, lz4 only if the
+lz4 package is installed on both sides.
+
+A QUERY_ASCII request (payload: ASCII_PARAMS, the pyvisa converter character
+and the separator, followed by the query) makes the server parse the response
+as separated numbers. The reply is the raw array of the values with the
+dtype ASCII_TYPES[converter].
+
+A request with DEADLINE_FLAG set in its opcode starts its payload with the
+time in s (SECONDS) the client is willing to wait for it, counted from its
+arrival at the server. If that time has passed before the request gets to
+the instrument, the server drops it and replies with STATUS_TIMEOUT and an
+error message.
+
+The servers write their port number, host address and, on POSIX systems, the
+path of an additional AF_UNIX socket to the port file, one per line. Clients on
+the same host connect through the AF_UNIX socket, which saves the TCP/IP stack
+on every request.
+"""
+
+import os
+import json
+import zlib
+import struct
+
+try:
+    import lz4.frame
+except ImportError: # optional, zlib is used instead
+    lz4 = None
+
+MAGIC = 0xB1
+HEADER = struct.Struct('<BBHI')
+ITEM = struct.Struct('<BI')
+BINARY_PARAMS = struct.Struct('<cBBI')
+SHARED_DESCRIPTOR = struct.Struct('<Q')
+THRESHOLD = struct.Struct('<I')
+SECONDS = struct.Struct('<d')
+SUBSCRIPTION = struct.Struct('<I')
+TIMESTAMP = struct.Struct('<d')
+LOCK_PARAMS = struct.Struct('<dd')
+JOB = struct.Struct('<I')
+JOB_STATE = struct.Struct('<BQ')
+COMPRESSION_PARAMS = struct.Struct('<BI')
+ASCII_PARAMS = struct.Struct('<cc')
+MAX_REQUEST_ID = 0xFFFFFFFF
+PUBLISH_BACKLOG = 64 # published frames queued per connection or subscription, the oldest are dropped beyond
+
+# request opcodes
+OPEN = 1
+CONF = 2
+WRITE = 3
+READ = 4
+QUERY = 5
+CLOSE = 6
+BATCH = 7
+QUERY_BINARY = 8
+GETATTR = 9
+SHARE = 10
+RELEASE = 11
+CACHE = 12
+SUBSCRIBE = 13
+UNSUBSCRIBE = 14
+PRIORITY = 15
+LOCK = 16
+UNLOCK = 17
+CLEAR = 18
+STATS = 19
+DEFINE_MACRO = 20
+RUN_MACRO = 21
+START_JOB = 22
+FETCH_JOB = 23
+CANCEL_JOB = 24
+COMPRESS = 25
+QUERY_ASCII = 26
+DEADLINE_FLAG = 0x80 # or'ed to the opcode of a request carrying a deadline
+
+TASKS = {OPEN: "OPEN", CONF: "CONF", WRITE: "WRITE", READ: "READ",
+         QUERY: "QUERY", CLOSE: "CLOSE", BATCH: "BATCH",
+         QUERY_BINARY: "QUERY_BINARY", GETATTR: "GETATTR",
+         SHARE: "SHARE", RELEASE: "RELEASE", CACHE: "CACHE",
+         SUBSCRIBE: "SUBSCRIBE", UNSUBSCRIBE: "UNSUBSCRIBE", PRIORITY: "PRIORITY",
+         LOCK: "LOCK", UNLOCK: "UNLOCK", CLEAR: "CLEAR", STATS: "STATS",
+         DEFINE_MACRO: "DEFINE_MACRO", RUN_MACRO: "RUN_MACRO",
+         START_JOB: "START_JOB", FETCH_JOB: "FETCH_JOB", CANCEL_JOB: "CANCEL_JOB",
+         COMPRESS: "COMPRESS", QUERY_ASCII: "QUERY_ASCII"}
+# tasks concerning only the connection itself, handled without touching instruments
+CONNECTION_TASKS = ("SHARE", "RELEASE", "PRIORITY", "STATS", "COMPRESS")
+OPCODES = {task: opcode for opcode, task in TASKS.items()}
+# requests which may carry a deadline, the others must not be dropped
+DEADLINE_TASKS = (CONF, WRITE, READ, QUERY, BATCH, QUERY_BINARY, GETATTR, CLEAR, RUN_MACRO, START_JOB,
+                  QUERY_ASCII)
+
+# reply statuses
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_SHARED = 2
+STATUS_PUBLISH = 3
+STATUS_PUBLISH_ERROR = 4
+STATUS_COMPRESSED = 5
+STATUS_TIMEOUT = 6
+
+# compression algorithms
+ZLIB = 1
+LZ4 = 2
+COMPRESSION = {'zlib': ZLIB, 'lz4': LZ4}
+ZLIB_LEVEL = 1 # fast, still shrinks ASCII traces severalfold
+
+# acquisition job states
+JOB_RUNNING = 0
+JOB_DONE = 1
+JOB_FAILED = 2
+
+MIN_SEGMENT_SIZE = 1 << 20
+MAX_FREE_SEGMENTS = 4 # per connection, kept for reuse
+
+ENCODING = 'utf-8'
+
+# priority classes of requests, lower is served first
+INTERACTIVE = 0
+ACQUISITION = 1
+BACKGROUND = 2
+PRIORITIES = {'interactive': INTERACTIVE, 'acquisition': ACQUISITION, 'background': BACKGROUND}
+
+# binary block header formats understood by pyvisa
+HEADER_FORMATS = ('ieee', 'hp', 'empty')
+BIG_ENDIAN = 1
+EXPECT_TERMINATION = 2
+# struct (standard size) datatypes whose numpy character code differs
+NUMPY_TYPES = {'l': 'i4', 'L': 'u4'}
+# pyvisa ASCII converters parsed by the server and the dtypes of their values
+ASCII_TYPES = {'f': '<f8', 'e': '<f8', 'g': '<f8', 'd': '<i8', 'i': '<i8'}
+
+def frame_message(data) -> bytes:
+    "Prefixes data with the multiprocessing.connection length header, for asyncio streams."
+    size = len(data)
+    if size > 0x7fffffff:
+        return struct.pack('!i', -1) + struct.pack('!Q', size) + data
+    return struct.pack('!i', size) + data
+
+async def read_message(reader) -> bytes:
+    "Reads one message in the multiprocessing.connection framing from an asyncio.StreamReader."
+    size, = struct.unpack('!i', await reader.readexactly(4))
+    if size == -1:
+        size, = struct.unpack('!Q', await reader.readexactly(8))
+    return await reader.readexactly(size)
+
+def unix_socket_path(port_filename: str):
+    "Path of the AF_UNIX socket next to the port file, None where unsupported."
+    if os.name != 'posix':
+        return None
+    return os.path.splitext(port_filename)[0] + '.sock'
+
+def write_port_file(port_filename: str, port: int, host: str, unix_path=None):
+    with open(port_filename, 'w') as port_file:
+        port_file.write(f"{port}\n")
+        port_file.write(f"{host}\n")
+        if unix_path:
+            port_file.write(f"{unix_path}\n")
+
+def read_port_file(port_filename: str):
+    """
+    Inverse of write_port_file.
+
+    Returns
+    -------
+    tuple
+        (port, host, unix_path), unix_path is None if the server has no
+        AF_UNIX socket.
+    """
+    with open(port_filename, 'r') as port_file:
+        lines = [line.strip() for line in port_file]
+    port = int(lines[0])
+    host = lines[1] if len(lines) > 1 else ''
+    unix_path = lines[2] if len(lines) > 2 and lines[2] else None
+    return port, host, unix_path
+
+def is_binary(data) -> bool:
+    "True if the received message is a binary frame (as opposed to a pickled string)."
+    return len(data) >= HEADER.size and data[0] == MAGIC
+
+def pack_frame(opcode: int, resource_id: int, request_id: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(MAGIC, opcode, resource_id, request_id) + payload
+
+def with_deadline(opcode: int, payload: bytes, timeout: float):
+    "Opcode and payload of a request which the server drops after timeout s."
+    return opcode | DEADLINE_FLAG, SECONDS.pack(timeout) + payload
+
+def split_deadline(opcode: int, payload):
+    """
+    Inverse of with_deadline.
+
+    Returns
+    -------
+    tuple
+        (opcode, payload, timeout), timeout is None for requests without a deadline.
+    """
+    if not opcode & DEADLINE_FLAG:
+        return opcode, payload, None
+    timeout, = SECONDS.unpack_from(payload)
+    return opcode & ~DEADLINE_FLAG, payload[SECONDS.size:], timeout
+
+def unpack_frame(data):
+    """
+    Splits a received binary frame.
+
+    Returns
+    -------
+    tuple
+        (opcode, resource_id, request_id, payload), the payload is a memoryview
+        into data to avoid copying large replies.
+    """
+    magic, opcode, resource_id, request_id = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"Bad frame magic {magic:#x}")
+    return opcode, resource_id, request_id, memoryview(data)[HEADER.size:]
+
+def encode(text: str) -> bytes:
+    return text.encode(ENCODING)
+
+def decode(payload) -> str:
+    return str(payload, ENCODING)
+
+def pack_items(items) -> bytes:
+    "Packs an iterable of (code, payload) pairs, e.g. the sub-requests of a BATCH."
+    return b''.join(ITEM.pack(code, len(payload)) + payload for code, payload in items)
+
+def unpack_items(payload):
+    "Inverse of pack_items, returns a list of (code, payload) pairs."
+    payload = memoryview(payload)
+    items = []
+    offset = 0
+    while offset < len(payload):
+        code, length = ITEM.unpack_from(payload, offset)
+        offset += ITEM.size
+        items.append((code, payload[offset:offset + length]))
+        offset += length
+    return items
+
+def unpack_results(tasks, payload) -> list:
+    """
+    Decodes the reply to a BATCH or RUN_MACRO with the given tasks, raises
+    RuntimeError for the first failed step.
+
+    Returns
+    -------
+    list
+        The responses, None for writes.
+    """
+    results = []
+    for task, (status, resp) in zip(tasks, unpack_items(payload)):
+        if status == STATUS_ERROR:
+            raise RuntimeError(decode(resp))
+        results.append(None if task == 'WRITE' else decode(resp))
+    return results
+
+def pack_macro(name: str, steps) -> bytes:
+    "DEFINE_MACRO payload, steps are (task, template) pairs with task 'WRITE', 'READ' or 'QUERY'."
+    if '\n' in name:
+        raise ValueError("Macro names cannot contain newlines")
+    return encode(name) + b'\n' + pack_items((OPCODES[task], encode(template)) for task, template in steps)
+
+def unpack_macro(payload):
+    "Inverse of pack_macro, returns (name, steps)."
+    payload = memoryview(payload)
+    end = bytes(payload).index(b'\n')
+    steps = [(TASKS.get(code), decode(template)) for code, template in unpack_items(payload[end + 1:])]
+    return decode(payload[:end]), steps
+
+def macro_parameter(value):
+    """
+    JSON form of numpy scalars (e.g. np.int64 from a sweep) passed to macros,
+    the Python scalar formats like the numpy one.
+    """
+    if type(value).__module__ == 'numpy' and hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Macro parameter {value!r} of type {type(value).__name__} is not supported")
+
+def pack_run_macro(name: str, params: dict) -> bytes:
+    return encode(name) + b'\n' + encode(json.dumps(params, default=macro_parameter))
+
+def unpack_run_macro(payload):
+    "Inverse of pack_run_macro, returns (name, params)."
+    name, params = decode(payload).split('\n', 1)
+    return name, json.loads(params)
+
+def compression_available(algorithm: int) -> bool:
+    return algorithm == ZLIB or (algorithm == LZ4 and lz4 is not None)
+
+def compress(algorithm: int, data) -> bytes:
+    if algorithm == LZ4:
+        return lz4.frame.compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+def decompress(algorithm: int, data) -> bytes:
+    if algorithm == LZ4:
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+def pack_ascii_query(msg: str, converter='f', separator=',') -> bytes:
+    return ASCII_PARAMS.pack(converter.encode('ascii'), separator.encode('ascii')) + encode(msg)
+
+def unpack_ascii_query(payload):
+    "Inverse of pack_ascii_query, returns (msg, converter, separator)."
+    converter, separator = ASCII_PARAMS.unpack_from(payload)
+    return decode(payload[ASCII_PARAMS.size:]), converter.decode('ascii'), separator.decode('ascii')
+
+def pack_job_data(state: int, points: int, channels) -> bytes:
+    "FETCH_JOB reply payload, channels are the raw data (bytes) of every channel."
+    return JOB_STATE.pack(state, points) + pack_items(enumerate(channels))
+
+def unpack_job_data(payload):
+    """
+    Inverse of pack_job_data.
+
+    Returns
+    -------
+    tuple
+        (state, points, channels), channels is a list of memoryviews.
+    """
+    state, points = JOB_STATE.unpack_from(payload)
+    return state, points, [data for _, data in unpack_items(payload[JOB_STATE.size:])]
+
+def pack_binary_query(msg: str, datatype='f', is_big_endian=False, header_fmt='ieee',
+                      expect_termination=True, data_points=0) -> bytes:
+    flags = (BIG_ENDIAN if is_big_endian else 0) | (EXPECT_TERMINATION if expect_termination else 0)
+    params = BINARY_PARAMS.pack(datatype.encode('ascii'), flags,
+                                HEADER_FORMATS.index(header_fmt), data_points or 0)
+    return params + encode(msg)
+
+def unpack_binary_query(payload):
+    """
+    Inverse of pack_binary_query.
+
+    Returns
+    -------
+    tuple
+        (msg, kwargs), kwargs are the keyword arguments for pyvisa's
+        query_binary_values.
+    """
+    datatype, flags, header_fmt, data_points = BINARY_PARAMS.unpack_from(payload)
+    kwargs = {'datatype': datatype.decode('ascii'),
+              'is_big_endian': bool(flags & BIG_ENDIAN),
+              'header_fmt': HEADER_FORMATS[header_fmt],
+              'expect_termination': bool(flags & EXPECT_TERMINATION),
+              'data_points': data_points}
+    return decode(payload[BINARY_PARAMS.size:]), kwargs
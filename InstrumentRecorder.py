@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:10:48 2026
+
+Recording and replay of the VISA traffic of the instrument server.
+
+TrafficRecorder appends every VISA operation (request, response, timestamp and
+latency) to a compact binary log. ReplayResourceManager serves a recorded log
+back as simulated instruments, either to VISAInstruments or directly to the
+drivers (as their rm), so that driver code can be profiled and regression
+tested without hardware.
+
+The log starts with MAGIC, followed by records of a RECORD header and the
+request and response bytes. The first record of every address has the
+operation ADDRESS and the address as its request, later records refer to it
+by index. The operations are the opcodes of InstrumentProtocol.
+"""
+
+import time
+import struct
+import threading as thr
+from collections import defaultdict, deque
+import numpy as np
+
+try:
+    from . import InstrumentProtocol as proto
+except ImportError: # imported by InstrumentServer running as a script
+    import InstrumentProtocol as proto
+
+MAGIC = b'IREC\x01'
+RECORD = struct.Struct('<ddBHII') # timestamp, latency, operation, address index, request and response length
+ADDRESS = 0
+
+class TrafficRecorder:
+    """
+    Writes the binary traffic log. Records are packed without any formatting
+    and written through a buffered file under a lock, so recording costs little
+    more than the write of the bytes.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.lock = thr.Lock()
+        self.addresses = {} # address -> index in the log
+    
+    def record(self, addr, op, request, response, timestamp, latency):
+        with self.lock:
+            index = self.addresses.get(addr)
+            if index is None:
+                index = self.addresses[addr] = len(self.addresses)
+                name = proto.encode(addr)
+                self.file.write(RECORD.pack(timestamp, 0.0, ADDRESS, index, len(name), 0) + name)
+            self.file.write(RECORD.pack(timestamp, latency, op, index, len(request), len(response)))
+            self.file.write(request)
+            self.file.write(response)
+    
+    def wrap(self, addr, dev):
+        "Returns dev with its I/O recorded."
+        return RecordingResource(addr, dev, self)
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class RecordingResource:
+    "Proxy of a pyvisa resource which records its I/O, other attributes are passed through."
+    def __init__(self, addr, dev, recorder):
+        object.__setattr__(self, 'addr', addr)
+        object.__setattr__(self, 'dev', dev)
+        object.__setattr__(self, 'recorder', recorder)
+    
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+    
+    def __setattr__(self, name, value):
+        setattr(self.dev, name, value)
+    
+    def record(self, op, request, response, start, timestamp):
+        self.recorder.record(self.addr, op, request, response, timestamp, time.perf_counter() - start)
+    
+    def write(self, msg):
+        timestamp, start = time.time(), time.perf_counter()
+        resp = self.dev.write(msg)
+        self.record(proto.WRITE, proto.encode(msg), b'', start, timestamp)
+        return resp
+    
+    def read(self):
+        timestamp, start = time.time(), time.perf_counter()
+        resp = self.dev.read()
+        self.record(proto.READ, b'', proto.encode(resp), start, timestamp)
+        return resp
+    
+    def query(self, msg):
+        timestamp, start = time.time(), time.perf_counter()
+        resp = self.dev.query(msg)
+        self.record(proto.QUERY, proto.encode(msg), proto.encode(resp), start, timestamp)
+        return resp
+    
+    def query_binary_values(self, msg, container=list, **kwargs):
+        "Records the raw data, the values are converted afterwards."
+        return convert_binary(self.query_block(msg, **kwargs), container, **kwargs)
+    
+    def query_block(self, msg, **kwargs):
+        "Raw data of a binary query, recorded under the caller's block format."
+        timestamp, start = time.time(), time.perf_counter()
+        data = query_block(self.dev, msg, **kwargs)
+        self.record(proto.QUERY_BINARY, binary_request(msg, kwargs), data, start, timestamp)
+        return data
+    
+    def clear(self):
+        timestamp, start = time.time(), time.perf_counter()
+        self.dev.clear()
+        self.record(proto.CLEAR, b'', b'', start, timestamp)
+
+def query_block(dev, msg, datatype='f', is_big_endian=False, data_points=0, **kwargs) -> bytes:
+    """
+    Raw data of a binary block query of the pyvisa resource dev, header
+    stripped. pyvisa unpacks the block into values before it applies the
+    container, so the block is read with datatype 's', which pyvisa returns
+    as one bytes object, and data_points is scaled to bytes. The keyword
+    arguments are those of query_binary_values. Recording and replayed
+    resources are passed the block format as it is, since that identifies
+    the query in the recording.
+    """
+    if isinstance(dev, (RecordingResource, ReplayResource)):
+        return dev.query_block(msg, datatype=datatype, is_big_endian=is_big_endian, data_points=data_points,
+                               **kwargs)
+    return dev.query_binary_values(msg, datatype='s', container=bytes,
+                                   data_points=data_points*struct.calcsize(datatype), **kwargs)
+
+def binary_request(msg, kwargs) -> bytes:
+    "Recorded form of a binary query, its message and block format."
+    params = ('datatype', 'is_big_endian', 'header_fmt', 'expect_termination', 'data_points')
+    return proto.pack_binary_query(msg, **{k: v for k, v in kwargs.items() if k in params})
+
+def convert_binary(data, container, datatype='f', is_big_endian=False, **kwargs):
+    "Raw block data as container of values, like pyvisa's query_binary_values."
+    if container in (bytes, bytearray):
+        return container(data)
+    dtype = np.dtype(proto.NUMPY_TYPES.get(datatype, datatype)).newbyteorder('>' if is_big_endian else '<')
+    values = np.frombuffer(data, dtype=dtype)
+    if container is np.ndarray:
+        return values
+    if container is list:
+        return values.tolist()
+    return container(values)
+
+def read_records(filename):
+    """
+    Reads a traffic log.
+
+    Yields
+    ------
+    tuple
+        (timestamp, latency, address, operation, request, response), request
+        and response are bytes.
+    """
+    addresses = {}
+    with open(filename, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a traffic log")
+        while header := file.read(RECORD.size):
+            timestamp, latency, op, index, request_size, response_size = RECORD.unpack(header)
+            request = file.read(request_size)
+            response = file.read(response_size)
+            if op == ADDRESS:
+                addresses[index] = proto.decode(request)
+                continue
+            yield timestamp, latency, addresses[index], op, request, response
+
+class ReplayResource:
+    """
+    Simulated instrument answering from a recording. The responses to each
+    (operation, request) pair are returned in their recorded order, the last
+    one is repeated once they are used up. Writes are accepted and collected
+    in writes. With speed > 0 every operation takes its recorded latency
+    divided by speed.
+    """
+    def __init__(self, resource_name, responses, speed=0.0):
+        self.resource_name = resource_name
+        self.responses = responses # (op, request) -> deque of (latency, response)
+        self.speed = speed
+        self.timeout = 2000
+        self.writes = []
+    
+    def replay(self, op, request):
+        queue = self.responses.get((op, request))
+        if not queue:
+            raise KeyError(f"No recorded response to {proto.TASKS[op]} {request!r} of {self.resource_name}")
+        latency, response = queue.popleft() if len(queue) > 1 else queue[0]
+        if self.speed > 0:
+            time.sleep(latency/self.speed)
+        return response
+    
+    def write(self, msg):
+        self.writes.append(msg)
+        if self.speed > 0 and (proto.WRITE, proto.encode(msg)) in self.responses:
+            self.replay(proto.WRITE, proto.encode(msg))
+        return len(msg)
+    
+    def read(self):
+        return proto.decode(self.replay(proto.READ, b''))
+    
+    def query(self, msg):
+        return proto.decode(self.replay(proto.QUERY, proto.encode(msg)))
+    
+    def query_ascii_values(self, msg, converter='f', separator=',', container=list):
+        "Parses the recorded response to the query, like pyvisa."
+        if isinstance(converter, str):
+            converter = {'f': float, 'e': float, 'g': float, 'd': int, 'i': int, 's': str}[converter]
+        values = [converter(value) for value in self.query(msg).strip().split(separator) if value]
+        return np.array(values) if container in (np.ndarray, np.array) else container(values)
+    
+    def query_binary_values(self, msg, container=list, **kwargs):
+        return convert_binary(self.query_block(msg, **kwargs), container, **kwargs)
+    
+    def query_block(self, msg, **kwargs):
+        return self.replay(proto.QUERY_BINARY, binary_request(msg, kwargs))
+    
+    def clear(self):
+        pass
+    
+    def close(self):
+        pass
+
+class ReplayResourceManager:
+    """
+    Stand-in for pyvisa.ResourceManager serving the instruments of a traffic
+    log recorded by TrafficRecorder, see ReplayResource.
+    """
+    def __init__(self, filename, speed=0.0):
+        self.speed = speed
+        self.responses = defaultdict(lambda: defaultdict(deque)) # address -> (op, request) -> responses
+        for _, latency, addr, op, request, response in read_records(filename):
+            self.responses[addr][op, request].append((latency, response))
+    
+    def open_resource(self, resource_name, **kwargs):
+        if resource_name not in self.responses:
+            raise KeyError(f"{resource_name} is not in the recording")
+        return ReplayResource(resource_name, self.responses[resource_name], self.speed)
+    
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.responses)
+    
+    def close(self):
+        pass
@@ -9,18 +9,75 @@ Created on Sat Dec 16 20:11:24 2023
 from multiprocessing.connection import Listener
 
 import os
+import time
+import socket
+import itertools
+import asyncio
 import threading as thr
-from queue import Queue
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from multiprocessing import shared_memory
 import tempfile
 import logging as log
 import pyvisa as visa
 import pickle
+import json
+import select
+import numpy as np
+
+try:
+    from . import InstrumentProtocol as proto
+    from .InstrumentStats import ServerStats
+    from .InstrumentRecorder import TrafficRecorder, ReplayResourceManager, query_block
+    from .InstrumentDirectory import DirectoryRegistration
+except ImportError: # running as a script
+    import InstrumentProtocol as proto
+    from InstrumentStats import ServerStats
+    from InstrumentRecorder import TrafficRecorder, ReplayResourceManager, query_block
+    from InstrumentDirectory import DirectoryRegistration
+
+POLL_INTERVAL = 1.0 # s between checks of idle and closing connections
+IDLE_TIMEOUT = 300.0 # s without requests after which a connection is closed
+PENDING_TIMEOUT = 10.0 # s a connection waits for a free handler before it is turned away
+MAX_COALESCED_LENGTH = 1024 # coalesced writes are sent once their line gets this long
+JOB_RETENTION = 3600.0 # s the data of an ended job are kept for its client
+
+# time.monotonic() after which the request being executed is dropped, set by RequestDispatcher.respond
+request_deadline = ContextVar('request_deadline', default=None)
+
+class DeadlineExceeded(TimeoutError):
+    "The deadline of a request passed before it got to the instrument."
+
+def parse_ascii_values(text: str, converter='f', separator=',') -> np.ndarray:
+    "Separated ASCII numbers as an array of dtype InstrumentProtocol.ASCII_TYPES[converter]."
+    values = text.strip().strip(separator)
+    if not values:
+        return np.empty(0, dtype=proto.ASCII_TYPES[converter])
+    return np.array(values.split(separator), dtype=proto.ASCII_TYPES[converter])
 
 class InstrumentClientListener:
     """
-    Class for establishing connections to clients and starting client handler threads.
+    Class for establishing connections to clients and serving them in a
+    bounded pool of handler threads.
+    
+    At most max_handlers connections are served at a time, further ones wait
+    for a free handler. A connection still waiting after pending_timeout
+    seconds gets a "server busy" error to its requests and is closed. Once
+    max_pending connections are waiting no more are accepted, so that new
+    clients wait in the listen backlog of the OS instead of piling up threads.
+    Connections without any request for idle_timeout seconds (None: never)
+    are closed unless they hold a lock or subscriptions, clients reconnect on
+    their next request. This applies only to connections speaking the binary
+    protocol, clients of the string protocol do not reconnect.
+    
+    The handlers pass the binary requests for an instrument to its executor
+    of at most workers_per_instrument threads, shared by all connections.
     """
-    def __init__(self, instruments, port=0, address=None, port_filename='instrument_server_port.txt'):
+    def __init__(self, instruments, port=0, address=None, port_filename='instrument_server_port.txt',
+                 max_handlers=64, max_pending=64, idle_timeout=IDLE_TIMEOUT, pending_timeout=PENDING_TIMEOUT,
+                 workers_per_instrument=16):
         if address is None:
             address = 'localhost'
         
@@ -29,50 +86,119 @@ class InstrumentClientListener:
         self.port_filename = os.path.join(tempfile.gettempdir(), port_filename)
         
         self.address = (address, self.port)
-        self.handlers = {} # running handlers
+        self.unix_path = proto.unix_socket_path(self.port_filename)
+        self.unix_listener = None
+        self.handlers = {} # served and waiting connections
+        self.handlers_lock = thr.Lock() # handlers are started by both accepting threads
         self.end_event = thr.Event() # for signaling running handlers
         self.handler_id = 0 # id of the next handler
-        self.finished_handlers = Queue() # handler threads which should be joined            
+        self.max_handlers = max_handlers
+        self.idle_timeout = idle_timeout
+        self.pending_timeout = pending_timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_handlers, thread_name_prefix='handler')
+        self.slots = thr.BoundedSemaphore(max_handlers + max_pending) # served plus waiting connections
+        self.workers_per_instrument = workers_per_instrument
+        self.executors = {} # addr -> executor for the requests of all connections to the instrument
+        self.executors_lock = thr.Lock()
+        self.started = thr.Event() # set once the port is known
+    
+    def executor(self, addr):
+        with self.executors_lock:
+            if addr not in self.executors:
+                self.executors[addr] = ThreadPoolExecutor(max_workers=self.workers_per_instrument,
+                                                          thread_name_prefix=addr)
+            return self.executors[addr]
+    
     def start(self):
         """
-        Opens the listener and saves the port number to a temporary file. Connections
-        are accepted by the blocking accept() method.
+        Opens the listeners and saves the port number and the AF_UNIX socket path
+        to a temporary file. TCP connections are accepted by the blocking accept()
+        method, local AF_UNIX connections by a separate thread.
 
         """
         self.listener = Listener(self.address)
         self.address = self.listener.address
         if self.port == 0: #port 0 means that the port was assigned automatically by the OS
             self.port = self.listener.address[1] #save the actual port
-        with open(self.port_filename, 'w') as port_file:
-            port_file.write(f"{self.port}\n")
-            port_file.write(f"{self.address[0]}\n")
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path): # left over by a server that crashed
+                os.remove(self.unix_path)
+            self.unix_listener = Listener(self.unix_path, family='AF_UNIX')
+            thr.Thread(target=self.accept_local, name="unix listener", daemon=True).start()
+        proto.write_port_file(self.port_filename, self.port, self.address[0], self.unix_path)
+        self.started.set()
         
-    def accept(self):
+    def accept(self, listener=None):
         """
-        Accepts a connection and starts its handler in a separate thread.
+        Accepts a connection and hands it to the handler pool. Blocks without
+        accepting while max_pending connections wait for a handler.
 
         """
-        conn = self.listener.accept()
-        log.info(f"Accepted {self.listener.last_accepted}")
-        handler_name = f"handler {self.handler_id}"
-        c = InstrumentClientHandler(conn, self.end_event, name=handler_name,
-                                    finished=self.finished_handlers, 
-                                    visa_instruments=self.instruments)
-        self.handlers[handler_name] = c
-        self.handlers[handler_name].start()
-        self.handler_id += 1
+        listener = listener or self.listener
+        self.slots.acquire()
+        try:
+            conn = listener.accept()
+        except BaseException:
+            self.slots.release()
+            raise
+        log.info(f"Accepted {listener.last_accepted or listener.address}")
+        with self.handlers_lock:
+            handler_name = f"handler {self.handler_id}"
+            handler = InstrumentClientHandler(conn, self.end_event, name=handler_name,
+                                              visa_instruments=self.instruments, executor=self.executor,
+                                              idle_timeout=self.idle_timeout)
+            self.handlers[handler_name] = handler
+            self.handler_id += 1
+            waiting = len(self.handlers) - self.max_handlers
+        if waiting > 0:
+            log.warning(f"{handler_name} waits for a free handler, {waiting} connections waiting")
+            timer = thr.Timer(self.pending_timeout, self.turn_away, (handler,))
+            timer.daemon = True
+            timer.start()
+        self.pool.submit(self.serve, handler)
+    
+    def serve(self, handler):
+        "Runs in a pool thread until the client disconnects."
+        if not handler.claim(): # turned away while it waited
+            return
+        try:
+            handler.run()
+        except Exception:
+            log.exception(f"problem with {handler.name}")
+        finally:
+            self.remove(handler)
     
-    def join_finished_handlers(self):
-        while not self.finished_handlers.empty():
-            name = self.finished_handlers.get()
-            log.info(f"Joining {name}")
-            self.handlers.pop(name).join()
+    def turn_away(self, handler):
+        "Rejects a connection which is still waiting for a handler after pending_timeout."
+        if not handler.claim(): # being served
+            return
+        log.warning(f"Turning away {handler.name}, no free handler within {self.pending_timeout} s")
+        try:
+            handler.reject(f"Server busy, all {self.max_handlers} handlers in use")
+        finally:
+            self.remove(handler)
+    
+    def remove(self, handler):
+        with self.handlers_lock:
+            del self.handlers[handler.name]
+        self.slots.release()
+    
+    def accept_local(self):
+        "Accepts AF_UNIX connections until the listener is closed."
+        while not self.end_event.is_set():
+            try:
+                self.accept(self.unix_listener)
+            except OSError: # listener closed
+                break
     
     def close_server(self):
-        log.info("Joining remaining handlers.")
+        log.info("Closing remaining connections.")
         self.end_event.set()
-        for c in self.handlers.values():
-            c.join()
+        if self.unix_listener is not None:
+            self.unix_listener.close() # also removes the socket file
+        self.pool.shutdown(wait=True) # the handlers notice end_event within POLL_INTERVAL
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
         log.info(f"Removing {self.port_filename}")
         os.remove(self.port_filename)
         log.info("Instrument server shutting down.")
@@ -80,7 +206,6 @@ class InstrumentClientListener:
     def loop(self):
         while True:
             self.accept() #blocking
-            self.join_finished_handlers()
     
     def __enter__(self):
         return self
@@ -91,44 +216,598 @@ class InstrumentClientListener:
         else: #propagate whatever exception happened
             return False
 
+class PriorityLock:
+    """
+    Lock whose waiters are served by priority class (see InstrumentProtocol.PRIORITIES,
+    lower is more urgent) and in arrival order within a class. A waiter gains
+    one class for every aging seconds it has been waiting, so that background
+    requests still get through under a constant load of more urgent ones.
+    """
+    def __init__(self, aging=1.0):
+        self.aging = aging
+        self.cond = thr.Condition(thr.Lock())
+        self.locked = False
+        self.waiters = [] # (priority, arrival time, sequence number)
+        self.sequence = itertools.count()
+    
+    def first_waiter(self):
+        now = time.monotonic()
+        return min(self.waiters, key=lambda w: (w[0] - (now - w[1])/self.aging, w[2]))
+    
+    def acquire(self, priority=proto.ACQUISITION, deadline=None):
+        """
+        Waits for the lock. With a deadline (time.monotonic()) the waiter gives
+        up when it passes and DeadlineExceeded is raised.
+        """
+        with self.cond:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded("Deadline passed before the request got to the instrument")
+            if not self.locked and not self.waiters:
+                self.locked = True
+                return
+            waiter = (priority, time.monotonic(), next(self.sequence))
+            self.waiters.append(waiter)
+            try:
+                while self.locked or self.first_waiter() is not waiter:
+                    if deadline is None:
+                        self.cond.wait()
+                    elif not self.cond.wait(deadline - time.monotonic()) and time.monotonic() >= deadline:
+                        self.cond.notify_all() # the first waiter may have changed
+                        raise DeadlineExceeded("Deadline passed while waiting for the instrument")
+            finally:
+                self.waiters.remove(waiter)
+            self.locked = True
+    
+    def release(self):
+        with self.cond:
+            self.locked = False
+            self.cond.notify_all()
+    
+    def queue_depth(self) -> int:
+        "Number of requests waiting for the lock."
+        return len(self.waiters)
+    
+    @contextmanager
+    def hold(self, priority=proto.ACQUISITION):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+class Lease:
+    """
+    Exclusive access of one client (the owner) to one resource for a sequence
+    of requests, e.g. a multi-command transaction. Requests of other clients
+    for the resource wait until the owner releases the lease or it expires.
+    """
+    def __init__(self):
+        self.cond = thr.Condition()
+        self.owner = None
+        self.expiry = 0
+    
+    def held_by_other(self, owner) -> bool:
+        return self.owner is not None and self.owner is not owner and time.monotonic() < self.expiry
+    
+    def wait(self, owner, timeout=None):
+        "Waits until the resource is not leased by anybody else than owner."
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.held_by_other(owner):
+                wait_time = self.expiry - time.monotonic()
+                if deadline is not None:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError("Timed out waiting for the lock held by another client")
+                    wait_time = min(wait_time, deadline - time.monotonic())
+                self.cond.wait(wait_time)
+    
+    def acquire(self, owner, duration, timeout=None):
+        "Leases the resource to owner for duration seconds, waiting at most timeout seconds."
+        with self.cond:
+            self.wait(owner, timeout)
+            self.owner = owner
+            self.expiry = time.monotonic() + duration
+    
+    def release(self, owner):
+        with self.cond:
+            if self.owner is owner:
+                self.owner = None
+                self.cond.notify_all()
+
 class RefCountedInstrument:
     "Simple wrapper for VISA resources that counts how many clients are open to it."
-    def __init__(self, dev):
+    def __init__(self, dev, lock):
         self.dev = dev
+        self.lock = lock # serializes the I/O on this resource (or on its whole bus)
+        self.lease = Lease()
         self.ref_counter = 1
+        self.pending_writes = [] # deferred writes to be coalesced, see VISAInstruments.set_coalescing
+        self.pending_length = 0
+        self.writes_lock = thr.Lock()
+        self.idle_timer = None # closes the resource once it has been unused for long enough
     def inc(self):
         self.ref_counter += 1
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
     def refclose(self):
+        "Drops a reference, the resource is closed by VISAInstruments once it is unused."
         self.ref_counter -= 1
-        if self.ref_counter == 0:
-            self.dev.close()
         return self.ref_counter
 
+class QueryPoller(thr.Thread):
+    """
+    Polls one query on one instrument at a fixed interval and publishes every
+    timestamped response to all its subscribers, so that the bus load does not
+    grow with the number of clients watching the same value.
+    """
+    def __init__(self, visa_instruments, addr, msg, interval):
+        super().__init__(name=f"poller {addr} {msg}", daemon=True)
+        self.visa_instruments = visa_instruments
+        self.addr = addr
+        self.msg = msg
+        self.interval = interval
+        self.subscribers = {} # subscription id -> push(frame) callback
+        self.stop_event = thr.Event()
+    
+    def publish(self, status, payload):
+        resource_id = self.visa_instruments.resource_ids[self.addr]
+        for sub_id, push in list(self.subscribers.items()):
+            try:
+                push(proto.pack_frame(status, resource_id, sub_id, payload))
+            except Exception as e: # the subscriber is gone
+                log.info(f"Dropping subscription {sub_id}: {e}")
+                self.subscribers.pop(sub_id, None)
+    
+    def run(self):
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                resp = self.visa_instruments.query(self.addr, self.msg, priority=proto.BACKGROUND)
+                self.publish(proto.STATUS_PUBLISH,
+                             proto.TIMESTAMP.pack(time.time()) + proto.encode(resp))
+            except Exception as e:
+                self.publish(proto.STATUS_PUBLISH_ERROR,
+                             proto.TIMESTAMP.pack(time.time()) + proto.encode(f"{type(e)} {e}"))
+            next_time = max(next_time + self.interval, time.monotonic())
+            self.stop_event.wait(next_time - time.monotonic())
+
+class AcquisitionJob:
+    """
+    Acquisition driven by the server, e.g. filling the data buffer of a lock-in
+    or a DMM sample run. Every step is a separate request to the instrument,
+    so that requests of other clients are served in between. The job
+    
+    1. executes the start steps as one batch,
+    2. every interval seconds queries poll for the number of points the
+       instrument has acquired,
+    3. fetches the new points in chunks of at most chunk points by querying
+       every channel template, formatted with start (index of the first point)
+       and count,
+    4. once all points are fetched executes the finish steps.
+    
+    The specification is a dict with the keys channels, points, poll,
+    interval, chunk, start and finish ([task, cmd] pairs) and binary, the
+    keyword arguments of query_binary_values for the channel queries, or None
+    for ASCII replies of comma separated values, which are converted to
+    float64. Fetched data wait in the job until a client takes them with
+    take(). run() is executed by a thread of VISAInstruments.start_job.
+    """
+    def __init__(self, visa_instruments, addr, spec, priority=proto.ACQUISITION, owner=None):
+        self.visa_instruments = visa_instruments
+        self.addr = addr
+        self.channels = list(spec['channels'])
+        self.points = int(spec['points'])
+        self.poll = spec['poll']
+        self.interval = float(spec.get('interval', 1.0))
+        self.chunk = int(spec.get('chunk', 1024))
+        self.start_steps = [tuple(step) for step in spec.get('start', ())]
+        self.finish_steps = [tuple(step) for step in spec.get('finish', ())]
+        self.binary = spec.get('binary')
+        if not self.channels or self.points <= 0 or self.chunk <= 0:
+            raise ValueError("A job needs channels, points > 0 and chunk > 0")
+        self.priority = priority
+        self.owner = owner
+        self.acquired = 0 # points fetched from the instrument
+        self.data = [[] for _ in self.channels] # per channel, chunks not taken yet
+        self.state = proto.JOB_RUNNING
+        self.error = None
+        self.finished_at = None
+        self.lock = thr.Lock()
+        self.stop_event = thr.Event()
+    
+    def run_steps(self, steps):
+        for error, _ in self.visa_instruments.batch(self.addr, steps, self.priority, self.owner):
+            if error is not None:
+                raise error
+    
+    def fetch(self, template, start, count) -> bytes:
+        msg = template.format(start=start, count=count)
+        if self.binary is None:
+            return self.visa_instruments.query_ascii(self.addr, msg, 'f', ',', self.priority, self.owner)
+        return self.visa_instruments.query_binary(self.addr, msg, self.priority, self.owner,
+                                                  **dict(self.binary, data_points=count))
+    
+    def run(self):
+        try:
+            self.run_steps(self.start_steps)
+            while self.acquired < self.points and not self.stop_event.wait(self.interval):
+                resp = self.visa_instruments.query(self.addr, self.poll, self.priority, self.owner)
+                available = min(int(float(resp)), self.points)
+                while self.acquired < available and not self.stop_event.is_set():
+                    count = min(self.chunk, available - self.acquired)
+                    chunk = [self.fetch(template, self.acquired, count) for template in self.channels]
+                    with self.lock:
+                        for data, new in zip(self.data, chunk):
+                            data.append(new)
+                        self.acquired += count
+        except Exception as e:
+            log.error(f"Job on {self.addr} failed: {e}")
+            self.error = f"{type(e)} {e}"
+        try:
+            self.run_steps(self.finish_steps)
+        except Exception as e:
+            log.error(f"Finishing the job on {self.addr} failed: {e}")
+            self.error = self.error or f"{type(e)} {e}"
+        with self.lock:
+            self.state = proto.JOB_FAILED if self.error is not None else proto.JOB_DONE
+            self.finished_at = time.monotonic()
+    
+    def take(self):
+        """
+        Hands out the data fetched since the last call.
+
+        Returns
+        -------
+        tuple
+            (state, points acquired, list of the raw data of every channel).
+        """
+        with self.lock:
+            channels = [b''.join(data) for data in self.data]
+            self.data = [[] for _ in self.channels]
+            return self.state, self.acquired, channels
+
+class StatsLogger(thr.Thread):
+    "Periodically writes the server statistics to the log as one JSON line."
+    def __init__(self, visa_instruments, interval):
+        super().__init__(name="stats logger", daemon=True)
+        self.visa_instruments = visa_instruments
+        self.interval = interval
+        self.stop_event = thr.Event()
+    
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            log.info(f"STATS {json.dumps(self.visa_instruments.snapshot())}")
+
 class VISAInstruments:
-    "Manager for all VISA communications, to be shared by all client handlers"
-    def __init__(self):
-        self.global_visa_lock = thr.Lock()
+    """
+    Manager for all VISA communications, to be shared by all client handlers.
+    
+    Every resource gets its own I/O lock, so that independent instruments can
+    be talked to in parallel. Resources on interfaces listed in shared_interfaces
+    (by prefix of the interface part of the address, e.g. 'GPIB' matches
+    'GPIB0::12::INSTR') share one lock per interface board, because they
+    really share a bus. The locks are PriorityLocks, so waiting requests are
+    served by their priority class.
+    
+    Responses to selected queries can be cached, cache maps VISA addresses to
+    dictionaries {query: time to live in s}. Cached responses are served without
+    touching the bus until they expire or until anything is written to the
+    instrument.
+    
+    resource_manager replaces the pyvisa ResourceManager, e.g. by a
+    MockVISA.MockResourceManager for benchmarks without hardware or an
+    InstrumentRecorder.ReplayResourceManager. With a recorder (see
+    InstrumentRecorder.TrafficRecorder) all VISA I/O is recorded.
+    
+    Writes to SCPI instruments can be coalesced, coalesce maps VISA addresses
+    to time windows in s, see set_coalescing().
+    
+    Resources nobody uses any more are kept open for keep_open seconds, so
+    that the next client does not pay for open_resource again (slow for GPIB
+    and serial instruments). The instruments in prewarm, a dict {VISA address:
+    configuration}, are opened and configured right away and stay open until
+    the server closes, see prewarm().
+    """
+    def __init__(self, shared_interfaces=('GPIB',), cache=None, resource_manager=None, recorder=None,
+                 coalesce=None, keep_open=0.0, prewarm=None):
         self.instruments = {}
-        self.rm = visa.ResourceManager()
+        self.instruments_lock = thr.Lock() # guards opening and closing of resources
+        self.shared_interfaces = tuple(iface.upper() for iface in shared_interfaces)
+        self.interface_locks = {}
+        self.resource_ids = {} # VISA address -> resource id used by the binary protocol
+        self.addresses = [] # resource id -> VISA address
+        self.cache_ttls = {} # VISA address -> {query: ttl}
+        self.cache = {} # VISA address -> {query: (expiry time, response)}
+        self.pollers = {} # (VISA address, query, interval) -> QueryPoller
+        self.subscriptions = {} # subscription id -> QueryPoller
+        self.subscription_id = 0
+        self.pollers_lock = thr.Lock()
+        self.stats = ServerStats()
+        self.macros = {} # VISA address -> {name: [(task, template)]}
+        self.coalesce_windows = {} # VISA address -> time window of write coalescing in s
+        self.jobs = {} # job id -> AcquisitionJob
+        self.job_id = 0
+        self.jobs_lock = thr.Lock()
+        self.keep_open = keep_open
+        self.pinned = set() # VISA addresses kept open while the server runs
+        for addr, ttls in (cache or {}).items():
+            for msg, ttl in ttls.items():
+                self.set_cache(addr, msg, ttl)
+        for addr, window in (coalesce or {}).items():
+            self.set_coalescing(addr, window)
+        self.rm = visa.ResourceManager() if resource_manager is None else resource_manager
+        self.recorder = recorder
+        for addr, conf in (prewarm or {}).items():
+            try:
+                self.prewarm(addr, conf)
+            except Exception as e:
+                log.error(f"Prewarming {addr} failed: {e}")
+    
+    @staticmethod
+    def interface_name(addr: str) -> str:
+        "Interface board part of a VISA address, e.g. 'GPIB0' for 'GPIB0::12::INSTR'."
+        return addr.split('::')[0].upper()
+    
+    def make_lock(self, addr: str):
+        "Returns the lock to be used for a newly opened resource at addr."
+        interface = self.interface_name(addr)
+        if self.shared_interfaces and interface.startswith(self.shared_interfaces):
+            return self.interface_locks.setdefault(interface, PriorityLock())
+        return PriorityLock()
+    
+    @contextmanager
+    def access(self, addr: str, priority=proto.ACQUISITION, owner=None):
+        """
+        Waits until the instrument is not leased by anybody else than owner and
+        holds its I/O lock (by priority) for the duration of the with block.
+        Yields the RefCountedInstrument. Raises DeadlineExceeded if the
+        deadline of the request (request_deadline) passes before.
+        """
+        inst = self.instruments[addr]
+        start = time.perf_counter()
+        queue_depth = inst.lock.queue_depth()
+        deadline = request_deadline.get()
+        while True:
+            try:
+                inst.lease.wait(owner, None if deadline is None else deadline - time.monotonic())
+                inst.lock.acquire(priority, deadline)
+            except DeadlineExceeded:
+                self.stats.record_expired(addr)
+                raise
+            except TimeoutError: # of the lease
+                self.stats.record_expired(addr)
+                raise DeadlineExceeded("Deadline passed while the instrument was locked by another client") from None
+            if not inst.lease.held_by_other(owner): # leased while we waited for the lock
+                break
+            inst.lock.release()
+        self.stats.record_lock_wait(addr, time.perf_counter() - start, queue_depth)
+        try:
+            if inst.pending_writes: # keep the order of the requests
+                self.flush_writes(addr, inst)
+            yield inst
+        finally:
+            inst.lock.release()
+    
+    def lock(self, addr: str, owner, timeout=None, duration=60.0):
+        """
+        Leases the instrument exclusively to owner for at most duration seconds.
+
+        Parameters
+        ----------
+        addr : string
+            The address of the instrument.
+        owner : object
+            The client, requests with the same owner are not blocked by the lease.
+        timeout : float or None, optional
+            Maximum time to wait for a lease of another client to end in s.
+        duration : float, optional
+            The lease expires automatically after this time in s.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.instruments[addr].lease.acquire(owner, duration, timeout)
+    
+    def unlock(self, addr: str, owner):
+        inst = self.instruments.get(addr)
+        if inst is not None:
+            inst.lease.release(owner)
+    
+    def snapshot(self) -> dict:
+        "Server statistics, see ServerStats.snapshot."
+        return self.stats.snapshot(self.queue_depths())
+    
+    def queue_depths(self) -> dict:
+        "Number of requests currently waiting for each instrument."
+        return {addr: inst.lock.queue_depth() for addr, inst in list(self.instruments.items())}
+    
+    def set_cache(self, addr: str, msg: str, ttl: float):
+        """
+        Enables caching of the responses to the query msg for ttl seconds
+        (float('inf') for values that never change, such as *IDN?). A ttl of
+        zero or less disables caching of msg.
+        """
+        ttls = self.cache_ttls.setdefault(addr, {})
+        if ttl > 0:
+            ttls[msg] = ttl
+        else:
+            ttls.pop(msg, None)
+            self.cache.get(addr, {}).pop(msg, None)
+    
+    def cached(self, addr: str, msg: str):
+        "Cached response to the query msg, or None if there is no valid entry."
+        entry = self.cache.get(addr, {}).get(msg)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
     
-    def open_instrument(self, addr, conf=None):
-        if addr not in self.instruments:
-            log.info(f"Opening new instrument at {addr}")
-            self.instruments[addr] = RefCountedInstrument(self.rm.open_resource(addr))
+    def store(self, addr: str, msg: str, resp: str):
+        "Remembers the response if caching is enabled for msg. Call with the lock held."
+        ttl = self.cache_ttls.get(addr, {}).get(msg)
+        if ttl is not None:
+            self.cache.setdefault(addr, {})[msg] = (time.monotonic() + ttl, resp)
+    
+    def invalidate(self, addr: str):
+        "Drops all cached responses of the instrument. Call with the lock held."
+        self.cache.pop(addr, None)
+    
+    def set_coalescing(self, addr: str, window: float):
+        """
+        Enables coalescing of the writes to the instrument at addr. Writes are
+        then acknowledged right away and sent window seconds later, together
+        with all writes arriving meanwhile, as one line of ';'-separated
+        commands. Any other request to the instrument sends the waiting writes
+        first, so the order of the requests is kept. Only for instruments
+        which understand SCPI command lines. A window of zero or less disables
+        coalescing.
+        
+        Errors of coalesced writes are raised by the request which sends them,
+        or logged if they are sent when the window ends.
+        """
+        if window > 0:
+            self.coalesce_windows[addr] = window
         else:
-            self.instruments[addr].inc()
-            log.info(f"Using already opened instrument at {addr}")
+            self.coalesce_windows.pop(addr, None)
+    
+    @staticmethod
+    def join_commands(msgs) -> str:
+        "SCPI commands as one line, later commands start again from the root of the command tree."
+        msgs = [msg.strip() for msg in msgs]
+        return ';'.join(msgs[:1] + [msg if msg.startswith((':', '*')) else ':' + msg for msg in msgs[1:]])
+    
+    def defer_write(self, addr: str, msg: str, window: float, priority=proto.ACQUISITION, owner=None):
+        "Queues a write to be coalesced, see set_coalescing()."
+        inst = self.instruments[addr]
+        inst.lease.wait(owner)
+        with inst.writes_lock:
+            self.invalidate(addr)
+            inst.pending_writes.append(msg)
+            inst.pending_length += len(msg) + 2
+            first = len(inst.pending_writes) == 1
+            full = inst.pending_length >= MAX_COALESCED_LENGTH
+        if full:
+            with inst.lock.hold(priority):
+                self.flush_writes(addr, inst)
+        elif first:
+            thr.Timer(window, self.flush_deferred, (addr, inst, priority)).start()
+    
+    def flush_deferred(self, addr: str, inst, priority):
+        "Sends the coalesced writes at the end of the window, unless another request did already."
+        try:
+            with inst.lock.hold(priority): # the writes passed the lease when they were queued
+                self.flush_writes(addr, inst)
+        except Exception as e:
+            log.error(str(e))
+    
+    def flush_writes(self, addr: str, inst):
+        "Sends the queued writes of inst as one line. Call with its I/O lock held."
+        with inst.writes_lock:
+            msgs, inst.pending_writes, inst.pending_length = inst.pending_writes, [], 0
+        if not msgs:
+            return
+        self.invalidate(addr)
+        line = self.join_commands(msgs)
+        try:
+            inst.dev.write(line)
+        except Exception as e:
+            raise RuntimeError(f"Coalesced write {line!r} to {addr} failed: {e}") from e
+    
+    def address_of(self, resource_id: int) -> str:
+        "VISA address belonging to a resource id handed out by open_instrument."
+        try:
+            return self.addresses[resource_id]
+        except IndexError:
+            raise ValueError(f"Unknown resource id {resource_id}") from None
+    
+    def open_instrument(self, addr, conf=None) -> int:
+        """
+        Opens the instrument at addr (or increases its reference count if it is
+        already open) and returns its resource id.
+        """
+        with self.instruments_lock:
+            if addr not in self.instruments:
+                log.info(f"Opening new instrument at {addr}")
+                dev = self.rm.open_resource(addr)
+                if self.recorder is not None:
+                    dev = self.recorder.wrap(addr, dev)
+                self.instruments[addr] = RefCountedInstrument(dev, self.make_lock(addr))
+            else:
+                inst = self.instruments[addr]
+                log.info(f"Using {'idle' if inst.ref_counter == 0 else 'already'} opened instrument at {addr}")
+                inst.inc()
+            if addr not in self.resource_ids:
+                self.resource_ids[addr] = len(self.addresses)
+                self.addresses.append(addr)
+            resource_id = self.resource_ids[addr]
         
         if conf is not None:
             self.configure_instrument(addr, conf)
+        return resource_id
     
     def close_instrument(self, addr):
-        count = self.instruments[addr].refclose()
-        if count == 0:
+        inst = self.instruments[addr]
+        if inst.pending_writes: # before instruments_lock, the bus may be busy for long
+            self.flush_deferred(addr, inst, proto.ACQUISITION)
+        with self.instruments_lock:
+            inst = self.instruments[addr]
+            if inst.refclose() > 0 or addr in self.pinned:
+                return
+            if self.keep_open > 0:
+                inst.idle_timer = thr.Timer(self.keep_open, self.close_idle, (addr, inst))
+                inst.idle_timer.daemon = True
+                inst.idle_timer.start()
+                return
             self.instruments.pop(addr)
-        
+            inst.dev.close()
+        self.invalidate(addr)
+    
+    def close_idle(self, addr: str, inst):
+        "Closes a resource at the end of its idle time, unless it has been opened again."
+        with self.instruments_lock:
+            if inst.ref_counter > 0 or self.instruments.get(addr) is not inst or addr in self.pinned:
+                return
+            self.instruments.pop(addr)
+            log.info(f"Closing instrument at {addr} unused for {self.keep_open} s")
+            inst.dev.close()
+        self.invalidate(addr)
     
-    def configure_instrument(self, addr: str, conf: dict) -> str:
+    def prewarm(self, addr: str, conf=None):
+        """
+        Opens and configures the instrument at addr without a client, it is
+        kept open until the server closes.
+
+        Parameters
+        ----------
+        addr : string
+            The address of the instrument.
+        conf : dict, optional
+            Attributes of the pyvisa resource to be set, see configure_instrument().
+
+        Returns
+        -------
+        None.
+
+        """
+        self.open_instrument(addr)
+        with self.instruments_lock:
+            self.pinned.add(addr)
+        try:
+            if conf:
+                self.configure_instrument(addr, conf)
+        finally:
+            self.close_instrument(addr)
+    
+    def configure_instrument(self, addr: str, conf: dict, priority=proto.ACQUISITION, owner=None) -> str:
         """
         Configure an already opened instruments
 
@@ -139,31 +818,276 @@ class VISAInstruments:
         conf : dict
             Dictionary of configuration options. The keys should be the attributes
             of the pyvisa resource that are meant to bet set
+        priority : int, optional
+            Priority class of the request, see InstrumentProtocol.PRIORITIES.
+        owner : object, optional
+            The client making the request, see lock().
 
         Returns
         -------
         None.
 
         """
-        for attr in conf:
-            setattr(self.instruments[addr].dev, attr, conf[attr])
+        with self.access(addr, priority, owner) as inst:
+            for attr in conf:
+                setattr(inst.dev, attr, conf[attr])
+    
+    def get_attribute(self, addr: str, attr: str, priority=proto.ACQUISITION, owner=None):
+        "Value of an attribute of the pyvisa resource, e.g. its timeout."
+        with self.access(addr, priority, owner) as inst:
+            return getattr(inst.dev, attr)
         
-    def write(self, addr: str, msg: str):
-        with self.global_visa_lock:
-            self.instruments[addr].dev.write(msg)
+    def write(self, addr: str, msg: str, priority=proto.ACQUISITION, owner=None):
+        window = self.coalesce_windows.get(addr)
+        if window is not None:
+            self.defer_write(addr, msg, window, priority, owner)
+            return
+        with self.access(addr, priority, owner) as inst:
+            self.invalidate(addr)
+            inst.dev.write(msg)
+    
+    def clear(self, addr: str, priority=proto.ACQUISITION, owner=None):
+        "VISA device clear."
+        with self.access(addr, priority, owner) as inst:
+            inst.dev.clear()
     
-    def read(self, addr: str) -> str:
-        with self.global_visa_lock:
-            resp = self.instruments[addr].dev.read()
+    def read(self, addr: str, priority=proto.ACQUISITION, owner=None) -> str:
+        with self.access(addr, priority, owner) as inst:
+            resp = inst.dev.read()
         return resp
     
-    def query(self, addr:str, msg: str) -> str:
-        with self.global_visa_lock:
-            resp =  self.instruments[addr].dev.query(msg)
+    def query(self, addr:str, msg: str, priority=proto.ACQUISITION, owner=None) -> str:
+        resp = self.cached(addr, msg)
+        if resp is not None:
+            return resp
+        with self.access(addr, priority, owner) as inst:
+            resp = inst.dev.query(msg)
+            self.store(addr, msg, resp)
+        return resp
+    
+    def query_ascii(self, addr: str, msg: str, converter='f', separator=',',
+                    priority=proto.ACQUISITION, owner=None) -> bytes:
+        """
+        Queries separated ASCII numbers (like pyvisa's query_ascii_values) and
+        returns their raw array, see parse_ascii_values. Served from the cache
+        like query().
+        """
+        if converter not in proto.ASCII_TYPES:
+            raise ValueError(f"Converter {converter} not supported by the server")
+        return parse_ascii_values(self.query(addr, msg, priority, owner), converter, separator).tobytes()
+    
+    def query_binary(self, addr: str, msg: str, priority=proto.ACQUISITION, owner=None, **kwargs) -> bytes:
+        """
+        Queries a binary block and returns its raw data (header stripped) without
+        converting it to numbers. The keyword arguments are those of pyvisa's
+        query_binary_values.
+        """
+        with self.access(addr, priority, owner) as inst:
+            resp = query_block(inst.dev, msg, **kwargs)
         return resp
     
+    def define_macro(self, addr: str, name: str, steps):
+        """
+        Registers the named command sequence name for the instrument at addr,
+        replacing an earlier one of the same name.
+
+        Parameters
+        ----------
+        addr : string
+            The address of the instrument.
+        name : string
+            Name of the macro, shared by all clients of the instrument.
+        steps : list
+            (task, template) pairs, task is one of "WRITE", "READ" or "QUERY"
+            and the template is formatted with the parameters of run_macro()
+            by str.format.
+        """
+        for task, _ in steps:
+            if task not in ("WRITE", "READ", "QUERY"):
+                raise ValueError(f"Task {task} not allowed in a macro")
+        with self.instruments_lock:
+            self.macros.setdefault(addr, {})[name] = list(steps)
+    
+    def run_macro(self, addr: str, name: str, params: dict, priority=proto.ACQUISITION, owner=None) -> list:
+        """
+        Executes a macro registered by define_macro() atomically, see batch().
+        """
+        try:
+            steps = self.macros[addr][name]
+        except KeyError:
+            raise KeyError(f"Unknown macro {name} for {addr}") from None
+        try:
+            ops = [(task, template.format(**params)) for task, template in steps]
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"Bad parameters for macro {name}: {e!r}") from None
+        return self.batch(addr, ops, priority, owner)
+    
+    def batch(self, addr: str, ops, priority=proto.ACQUISITION, owner=None) -> list:
+        """
+        Executes a sequence of operations on one resource under a single lock
+        acquisition, so that no other client can interleave with it.
+
+        Parameters
+        ----------
+        addr : string
+            The address of the instrument.
+        ops : list
+            (task, cmd) pairs, task is one of "WRITE", "READ" or "QUERY".
+        priority : int, optional
+            Priority class of the request, see InstrumentProtocol.PRIORITIES.
+        owner : object, optional
+            The client making the request, see lock().
+
+        Returns
+        -------
+        list
+            (error, response) pairs of the executed operations, error is None
+            on success. Execution stops at the first failing operation.
+        """
+        results = []
+        with self.access(addr, priority, owner) as inst:
+            for task, cmd in ops:
+                try:
+                    match task:
+                        case "WRITE":
+                            self.invalidate(addr)
+                            inst.dev.write(cmd)
+                            resp = None
+                        case "READ":
+                            resp = inst.dev.read()
+                        case "QUERY":
+                            resp = self.cached(addr, cmd)
+                            if resp is None:
+                                resp = inst.dev.query(cmd)
+                                self.store(addr, cmd, resp)
+                        case _:
+                            raise ValueError(f"Task {task} not allowed in a batch")
+                except Exception as e:
+                    results.append((e, None))
+                    break
+                results.append((None, resp))
+        return results
+    
+    def start_job(self, addr: str, spec: dict, priority=proto.ACQUISITION, owner=None) -> int:
+        """
+        Starts an acquisition job on the instrument at addr, see AcquisitionJob.
+        The job keeps the instrument open until it ends, its data wait for
+        fetch_job() even if the client disconnects meanwhile, at most
+        JOB_RETENTION seconds after the job ended.
+
+        Returns
+        -------
+        int
+            The job id.
+        """
+        job = AcquisitionJob(self, addr, spec, priority, owner)
+        self.open_instrument(addr)
+        with self.jobs_lock:
+            now = time.monotonic()
+            for job_id in [i for i, j in self.jobs.items()
+                           if j.finished_at is not None and now - j.finished_at > JOB_RETENTION]:
+                log.info(f"Dropping job {job_id}, its data were never fetched")
+                del self.jobs[job_id]
+            self.job_id = (self.job_id + 1) & proto.MAX_REQUEST_ID
+            job_id = self.job_id
+            self.jobs[job_id] = job
+        thr.Thread(target=self.run_job, args=(job,), name=f"job {job_id}", daemon=True).start()
+        return job_id
+    
+    def run_job(self, job):
+        try:
+            job.run()
+        finally:
+            self.close_instrument(job.addr)
+    
+    def job(self, job_id: int):
+        try:
+            return self.jobs[job_id]
+        except KeyError:
+            raise KeyError(f"Unknown job {job_id}") from None
+    
+    def fetch_job(self, job_id: int):
+        """
+        Data acquired by a job since the last fetch, see AcquisitionJob.take.
+        A job is forgotten once it ended and its data were fetched, for a
+        failed job that last fetch raises its error.
+        """
+        job = self.job(job_id)
+        state, points, channels = job.take()
+        if state == proto.JOB_FAILED and any(channels):
+            return state, points, channels # the error is raised by the next fetch
+        if state != proto.JOB_RUNNING:
+            with self.jobs_lock:
+                self.jobs.pop(job_id, None)
+            if state == proto.JOB_FAILED:
+                raise RuntimeError(f"Job {job_id} failed after {points} points: {job.error}")
+        return state, points, channels
+    
+    def cancel_job(self, job_id: int):
+        "Stops a job (after its current step and the finish steps) and discards its data."
+        with self.jobs_lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None:
+            job.stop_event.set()
+    
+    def subscribe(self, addr: str, msg: str, interval: float, push) -> int:
+        """
+        Subscribes to the responses to the query msg, polled every interval
+        seconds. Subscribers to the same query and interval share one poller.
+
+        Parameters
+        ----------
+        addr : string
+            The address of the instrument.
+        msg : string
+            The query.
+        interval : float
+            Polling interval in s.
+        push : callable
+            Called with every published frame by the shared poller thread,
+            must not block and should raise if the subscriber is gone.
+
+        Returns
+        -------
+        int
+            The subscription id, which is also the request id of the published frames.
+        """
+        with self.pollers_lock:
+            self.subscription_id = (self.subscription_id + 1) & proto.MAX_REQUEST_ID
+            sub_id = self.subscription_id
+            key = (addr, msg, interval)
+            poller = self.pollers.get(key)
+            if poller is None or not poller.is_alive():
+                poller = QueryPoller(self, addr, msg, interval)
+                self.pollers[key] = poller
+                poller.subscribers[sub_id] = push
+                poller.start()
+            else:
+                poller.subscribers[sub_id] = push
+            self.subscriptions[sub_id] = poller
+        return sub_id
+    
+    def unsubscribe(self, sub_id: int):
+        "Cancels a subscription, the poller stops with its last subscriber."
+        with self.pollers_lock:
+            poller = self.subscriptions.pop(sub_id, None)
+            if poller is None:
+                return
+            poller.subscribers.pop(sub_id, None)
+            if not poller.subscribers:
+                poller.stop_event.set()
+                self.pollers.pop((poller.addr, poller.msg, poller.interval), None)
+    
     def close(self):
-        for inst in self.instruments.values():
+        for poller in list(self.pollers.values()):
+            poller.stop_event.set()
+        for job in list(self.jobs.values()):
+            job.stop_event.set()
+        for addr, inst in self.instruments.items():
+            if inst.idle_timer is not None:
+                inst.idle_timer.cancel()
+            if inst.pending_writes:
+                self.flush_deferred(addr, inst, proto.ACQUISITION)
             inst.dev.close()
         self.rm.close()
     
@@ -176,14 +1100,17 @@ class VISAInstruments:
         else:
             return False
 
-class InstrumentClientHandler(thr.Thread):
-    def __init__(self, conn, end_event, name, finished, visa_instruments):
-        super().__init__()
-        self.conn = conn
-        self.end_event = end_event
-        self.name = name
-        self.finished = finished
-        self.visa_instruments = visa_instruments
+class RequestDispatcher:
+    """
+    Decoding, execution and encoding of client requests, shared by the threaded
+    InstrumentClientHandler and the asyncio AsyncClientConnection. Expects
+    the attributes name, visa_instruments, subscriptions and leases and a
+    push(frame) method, which sends an unsolicited frame to the client from any
+    thread. The dispatcher itself is the owner of the leases of its connection.
+    """
+    shm_threshold = None # replies at least this long go through shared memory
+    compression = None # (algorithm, threshold) of compressed replies
+    priority = proto.ACQUISITION # priority class of the requests of this connection
     
     @staticmethod
     def parse_msg(msg):
@@ -194,42 +1121,515 @@ class InstrumentClientHandler(thr.Thread):
             cmd = ' '.join(toks[2:])
         else:
             cmd = ''
+        if task == "CONF":
+            cmd = pickle.loads(bytes.fromhex(cmd))
         return task, addr, cmd
     
-    def run(self):
+    def parse_frame(self, data, received=None):
+        """
+        Decodes a binary frame into the same (task, addr, cmd) triple as
+        parse_msg, followed by the request id and the deadline, counted from
+        received (time.monotonic(), default now).
+        """
+        opcode, resource_id, request_id, payload = proto.unpack_frame(data)
+        opcode, payload, timeout = proto.split_deadline(opcode, payload)
+        deadline = None
+        if timeout is not None:
+            deadline = (time.monotonic() if received is None else received) + timeout
+        task = proto.TASKS.get(opcode)
+        if task is None:
+            raise ValueError(f"Unknown opcode {opcode}")
+        if task == "OPEN":
+            addr = proto.decode(payload)
+        elif task in proto.CONNECTION_TASKS:
+            addr = None
+        else:
+            addr = self.visa_instruments.address_of(resource_id)
+        if task == "CONF":
+            cmd = pickle.loads(payload)
+        elif task == "BATCH":
+            cmd = [(proto.TASKS.get(code), proto.decode(sub))
+                   for code, sub in proto.unpack_items(payload)]
+        elif task == "QUERY_BINARY":
+            cmd = proto.unpack_binary_query(payload)
+        elif task == "QUERY_ASCII":
+            cmd = proto.unpack_ascii_query(payload)
+        elif task == "SHARE":
+            cmd, = proto.THRESHOLD.unpack(payload)
+        elif task in ("CACHE", "SUBSCRIBE"):
+            seconds, = proto.SECONDS.unpack_from(payload)
+            cmd = (proto.decode(payload[proto.SECONDS.size:]), seconds)
+        elif task == "UNSUBSCRIBE":
+            cmd, = proto.SUBSCRIPTION.unpack(payload)
+        elif task == "PRIORITY":
+            cmd = payload[0]
+        elif task == "COMPRESS":
+            cmd = proto.COMPRESSION_PARAMS.unpack(payload)
+        elif task == "LOCK":
+            timeout, duration = proto.LOCK_PARAMS.unpack(payload)
+            cmd = (None if timeout < 0 else timeout, duration)
+        elif task == "DEFINE_MACRO":
+            cmd = proto.unpack_macro(payload)
+        elif task == "RUN_MACRO":
+            cmd = proto.unpack_run_macro(payload)
+        elif task == "START_JOB":
+            cmd = json.loads(proto.decode(payload))
+        elif task in ("FETCH_JOB", "CANCEL_JOB"):
+            cmd, = proto.JOB.unpack(payload)
+        else:
+            cmd = proto.decode(payload)
+        return task, addr, cmd, request_id, deadline
+    
+    def execute(self, task, addr, cmd):
+        """
+        Executes one request on the VISA instruments.
+
+        Returns
+        -------
+        str or int or list or None
+            The instrument response for READ and QUERY, the resource id for OPEN,
+            the list of (error, response) pairs for BATCH and RUN_MACRO, the job
+            id for START_JOB, the (state, points, channels) of FETCH_JOB and None
+            otherwise.
+        """
+        match task:
+            case "OPEN":
+                resource_id = self.visa_instruments.open_instrument(addr)
+                with self.opened_lock:
+                    self.opened[addr] += 1
+                return resource_id
+            case "CONF":
+                self.visa_instruments.configure_instrument(addr, cmd, self.priority, self)
+            case "WRITE":
+                self.visa_instruments.write(addr, cmd, self.priority, self)
+            case "READ":
+                return self.visa_instruments.read(addr, self.priority, self)
+            case "QUERY":
+                return self.visa_instruments.query(addr, cmd, self.priority, self)
+            case "CLOSE":
+                self.visa_instruments.unlock(addr, self)
+                self.leases.discard(addr)
+                with self.opened_lock:
+                    if self.opened[addr] == 0: # not opened by this connection, e.g. before a reconnect
+                        return None
+                    self.opened[addr] -= 1
+                self.visa_instruments.close_instrument(addr)
+            case "BATCH":
+                return self.visa_instruments.batch(addr, cmd, self.priority, self)
+            case "DEFINE_MACRO":
+                self.visa_instruments.define_macro(addr, *cmd)
+            case "RUN_MACRO":
+                name, params = cmd
+                return self.visa_instruments.run_macro(addr, name, params, self.priority, self)
+            case "QUERY_BINARY":
+                msg, kwargs = cmd
+                return self.visa_instruments.query_binary(addr, msg, self.priority, self, **kwargs)
+            case "QUERY_ASCII":
+                return self.visa_instruments.query_ascii(addr, *cmd, self.priority, self)
+            case "GETATTR":
+                return pickle.dumps(self.visa_instruments.get_attribute(addr, cmd, self.priority, self))
+            case "LOCK":
+                timeout, duration = cmd
+                self.visa_instruments.lock(addr, self, timeout, duration)
+                self.leases.add(addr)
+            case "UNLOCK":
+                self.visa_instruments.unlock(addr, self)
+                self.leases.discard(addr)
+            case "CLEAR":
+                self.visa_instruments.clear(addr, self.priority, self)
+            case "CACHE":
+                msg, ttl = cmd
+                self.visa_instruments.set_cache(addr, msg, ttl)
+            case "SUBSCRIBE":
+                msg, interval = cmd
+                sub_id = self.visa_instruments.subscribe(addr, msg, interval, self.publish)
+                self.subscriptions.add(sub_id)
+                return sub_id
+            case "UNSUBSCRIBE":
+                self.visa_instruments.unsubscribe(cmd)
+                self.subscriptions.discard(cmd)
+            case "START_JOB":
+                return self.visa_instruments.start_job(addr, cmd, self.priority, self)
+            case "FETCH_JOB":
+                return self.visa_instruments.fetch_job(cmd)
+            case "CANCEL_JOB":
+                self.visa_instruments.cancel_job(cmd)
+            case _:
+                raise ValueError(f"Unknown task {task}")
+    
+    def handle_string(self, data) -> bytes:
+        "Legacy protocol: space separated string messages and replies."
+        start = time.perf_counter()
+        task = addr = cmd = None
         try:
-            while True:
-                log.debug(f"{self.name} waiting for message")
-                msg = self.conn.recv()
-                task, addr, cmd = self.parse_msg(msg)
-                log.debug(f"{self.name} recv'd: task={task}, addr={addr}, cmd={cmd}")
+            task, addr, cmd = self.parse_msg(pickle.loads(data))
+            log.debug("%s recv'd: task=%s, addr=%s, cmd=%s", self.name, task, addr, cmd)
+            if task not in ("OPEN", "CONF", "WRITE", "READ", "QUERY", "CLOSE"):
+                raise ValueError(f"{task} requires the binary protocol")
+            resp = self.execute(task, addr, cmd)
+            if task in ("READ", "QUERY"):
+                reply = f"READ {resp}"
+            else:
+                reply = f"{task} OK"
+        except Exception as e:
+            log.debug("%s Error %s", self.name, e)
+            reply = f"ERROR {type(e)} {e}"
+        reply = pickle.dumps(reply)
+        self.visa_instruments.stats.record_request(addr, task, time.perf_counter() - start,
+                                                   len(data), len(reply), self.command_of(task, cmd))
+        return reply
+    
+    def handle_binary(self, data, received=None) -> bytes:
+        "Binary protocol, see InstrumentProtocol. received is the arrival time, see parse_frame."
+        try:
+            task, addr, cmd, request_id, deadline = self.parse_frame(data, received)
+        except Exception as e:
+            return self.binary_error(proto.HEADER.unpack_from(data)[3], e)
+        log.debug("%s recv'd: task=%s, addr=%s, request=%s", self.name, task, addr, request_id)
+        if task in proto.CONNECTION_TASKS:
+            return self.handle_connection_task(task, cmd, request_id)
+        return self.respond(task, addr, cmd, request_id, len(data), deadline)
+    
+    def respond(self, task, addr, cmd, request_id, size=0, deadline=None) -> bytes:
+        """
+        Executes a decoded binary request and returns the reply frame. The
+        size of the request frame is only used for the statistics. The
+        request is dropped if deadline (time.monotonic()) passes before it
+        gets to the instrument.
+        """
+        start = time.perf_counter()
+        token = request_deadline.set(deadline)
+        try:
+            resp = self.execute(task, addr, cmd)
+            reply = self.binary_reply(task, request_id, resp)
+        except Exception as e:
+            reply = self.binary_error(request_id, e)
+        finally:
+            request_deadline.reset(token)
+        self.visa_instruments.stats.record_request(addr, task, time.perf_counter() - start,
+                                                   size, len(reply), self.command_of(task, cmd))
+        return reply
+    
+    @staticmethod
+    def command_of(task, cmd):
+        "SCPI command (or macro name) of a request for the statistics, None for other tasks."
+        match task:
+            case "WRITE" | "QUERY":
+                return cmd
+            case "QUERY_BINARY" | "QUERY_ASCII" | "RUN_MACRO":
+                return cmd[0]
+        return None
+    
+    def handle_connection_task(self, task, cmd, request_id) -> bytes:
+        "Requests concerning only this connection."
+        match task:
+            case "SHARE":
+                self.shm_threshold = cmd
+            case "RELEASE":
+                for name in cmd.split('\n'):
+                    self.release_segment(name)
+            case "PRIORITY":
+                if cmd not in proto.PRIORITIES.values():
+                    return self.binary_error(request_id, ValueError(f"Unknown priority {cmd}"))
+                self.priority = cmd
+            case "STATS":
+                return self.binary_reply(task, request_id, json.dumps(self.visa_instruments.snapshot()))
+            case "COMPRESS":
+                algorithm, _ = cmd
+                if not proto.compression_available(algorithm):
+                    return self.binary_error(request_id, ValueError(f"Compression {algorithm} not available"))
+                self.compression = cmd
+        return self.binary_reply(task, request_id, None)
+    
+    def binary_reply(self, task, request_id, resp) -> bytes:
+        resource_id = 0
+        status = proto.STATUS_OK
+        if task == "OPEN":
+            resource_id = resp
+            payload = b''
+        elif task in ("BATCH", "RUN_MACRO"):
+            payload = self.pack_batch_results(resp)
+        elif task == "SUBSCRIBE":
+            payload = proto.SUBSCRIPTION.pack(resp)
+        elif task == "START_JOB":
+            payload = proto.JOB.pack(resp)
+        elif task == "FETCH_JOB":
+            payload = proto.pack_job_data(*resp)
+        elif resp is None:
+            payload = b''
+        elif isinstance(resp, (bytes, bytearray)):
+            payload = resp
+        else:
+            payload = proto.encode(resp)
+        if self.shm_threshold is not None and len(payload) >= self.shm_threshold:
+            payload = self.share(payload)
+            status = proto.STATUS_SHARED
+        elif self.compression is not None and len(payload) >= self.compression[1]:
+            compressed = proto.compress(self.compression[0], payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                status = proto.STATUS_COMPRESSED
+        return proto.pack_frame(status, resource_id, request_id, payload)
+    
+    def share(self, payload) -> bytes:
+        """
+        Copies payload into a shared memory segment and returns its descriptor.
+        Segments released by the client are reused, so that their pages do not
+        have to be allocated again for every reply.
+        """
+        size = len(payload)
+        with self.segments_lock:
+            fitting = [name for name in self.free_segments if self.segments[name].size >= size]
+            if fitting:
+                name = min(fitting, key=lambda name: self.segments[name].size)
+                self.free_segments.remove(name)
+                shm = self.segments[name]
+            else:
+                shm = shared_memory.SharedMemory(create=True, size=max(size, proto.MIN_SEGMENT_SIZE))
+                self.segments[shm.name] = shm
+        shm.buf[:size] = payload
+        return proto.SHARED_DESCRIPTOR.pack(size) + proto.encode(shm.name)
+    
+    def release_segment(self, name):
+        "The client does not use the segment anymore, keep it for reuse or unlink it."
+        with self.segments_lock:
+            if name not in self.segments:
+                return
+            if len(self.free_segments) < proto.MAX_FREE_SEGMENTS:
+                self.free_segments.append(name)
+                return
+            shm = self.segments.pop(name)
+        shm.close()
+        shm.unlink()
+    
+    def unlock_all(self):
+        "Releases the leases held by this connection."
+        for addr in list(self.leases):
+            self.visa_instruments.unlock(addr, self)
+        self.leases.clear()
+    
+    def close_all(self):
+        "Drops the references to the instruments this connection opened and did not close."
+        with self.opened_lock:
+            opened, self.opened = self.opened, Counter()
+        for addr, count in opened.items():
+            for _ in range(count):
                 try:
-                    match task:
-                        case "OPEN":
-                            self.visa_instruments.open_instrument(addr)
-                            reply = "OPEN OK"
-                        case "CONF":
-                            conf = pickle.loads(bytes.fromhex(cmd))
-                            self.visa_instruments.configure_instrument(addr, conf)
-                            reply = "CONF OK"
-                        case "WRITE":
-                            self.visa_instruments.write(addr, cmd)
-                            reply = "WRITE OK"
-                        case "READ":
-                            resp = self.visa_instruments.read(addr)
-                            reply = f"READ {resp}"
-                        case "QUERY":
-                            resp = self.visa_instruments.query(addr, cmd)
-                            reply = f"READ {resp}"
-                        case "CLOSE":
-                            self.visa_instruments.close_instrument(addr)
-                            reply = "CLOSE OK"
-                        case _:
-                            raise ValueError(f"Unknown task {task}")
+                    self.visa_instruments.close_instrument(addr)
                 except Exception as e:
-                    log.debug(f"{self.name} Error {e}")
-                    reply = f"ERROR {type(e)} {e}"
-                self.conn.send(reply)
+                    log.error(f"Closing {addr} for {self.name} failed: {e}")
+    
+    def unsubscribe_all(self):
+        for sub_id in list(self.subscriptions):
+            self.visa_instruments.unsubscribe(sub_id)
+        self.subscriptions.clear()
+    
+    def release_segments(self):
+        "Unlinks all segments of this connection."
+        with self.segments_lock:
+            for shm in self.segments.values():
+                shm.close()
+                shm.unlink()
+            self.segments.clear()
+            self.free_segments.clear()
+    
+    def binary_error(self, request_id, e) -> bytes:
+        log.debug("%s Error %s", self.name, e)
+        status = proto.STATUS_TIMEOUT if isinstance(e, DeadlineExceeded) else proto.STATUS_ERROR
+        return proto.pack_frame(status, 0, request_id, proto.encode(f"{type(e)} {e}"))
+    
+    @staticmethod
+    def pack_batch_results(results) -> bytes:
+        items = []
+        for error, resp in results:
+            if error is not None:
+                items.append((proto.STATUS_ERROR, proto.encode(f"{type(error)} {error}")))
+            else:
+                items.append((proto.STATUS_OK, b'' if resp is None else proto.encode(resp)))
+        return proto.pack_items(items)
+
+class InstrumentClientHandler(RequestDispatcher):
+    """
+    Serves one client connection in a thread of the InstrumentClientListener's
+    pool. Binary requests for instruments are executed by the instrument's
+    executor (executor(addr) returns it), so that the clients of a process
+    which share one connection are not held up by a slow instrument of
+    another. The requests of the connection for the same instrument keep
+    their order, only the oldest one is handed to the executor at a time.
+    """
+    def __init__(self, conn, end_event, name, visa_instruments, executor, idle_timeout=None):
+        self.conn = conn
+        self.end_event = end_event
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.visa_instruments = visa_instruments
+        self.executor = executor
+        self.segments = {} # name -> shared memory segment of this connection
+        self.free_segments = [] # names of segments released by the client
+        self.segments_lock = thr.Lock()
+        self.subscriptions = set()
+        self.leases = set() # addresses leased by this connection
+        self.opened = Counter() # VISA address -> OPENs of this connection not closed yet
+        self.opened_lock = thr.Lock()
+        self.send_lock = thr.Lock() # replies and published frames come from different threads
+        self.published = deque(maxlen=proto.PUBLISH_BACKLOG) # frames for the publisher thread, None once closing
+        self.published_cond = thr.Condition()
+        self.publisher = None # sends the published frames, started by the first one
+        self.queues = {} # resource id -> requests for the instrument not answered yet, the first is executing
+        self.in_flight = 0 # requests in the queues
+        self.in_flight_cond = thr.Condition() # guards queues and in_flight
+        self.binary_protocol = False # set by the first binary request, only such clients reconnect
+        self.claimed = thr.Lock() # taken by whoever serves or rejects the connection
+        self.poller = None # a poll object is much cheaper per message than conn.poll
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(conn.fileno(), select.POLLIN)
+    
+    def push(self, frame):
+        with self.send_lock:
+            self.conn.send_bytes(frame)
+    
+    def publish(self, frame):
+        """
+        Queues a published frame for the publisher thread, so that the shared
+        poller never waits for a client that does not read. If the client
+        lags behind by InstrumentProtocol.PUBLISH_BACKLOG frames the oldest are dropped.
+        """
+        with self.published_cond:
+            if self.published is None:
+                raise ConnectionError(f"{self.name} is closing")
+            if self.publisher is None:
+                self.publisher = thr.Thread(target=self.send_published, name=f"{self.name} publisher",
+                                            daemon=True)
+                self.publisher.start()
+            self.published.append(frame)
+            self.published_cond.notify()
+    
+    def send_published(self):
+        while True:
+            with self.published_cond:
+                while self.published is not None and not self.published:
+                    self.published_cond.wait()
+                if self.published is None: # connection closing
+                    return
+                frame = self.published.popleft()
+            try:
+                self.push(frame)
+            except OSError:
+                return
+    
+    def stop_publishing(self):
+        "Ends the publisher thread, which may be blocked sending to a client that does not read."
+        with self.published_cond:
+            publisher, self.published = self.publisher, None
+            self.published_cond.notify()
+        if publisher is not None and publisher.is_alive():
+            try: # fails the blocked send, which holds send_lock
+                with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            publisher.join()
+    
+    def submit(self, data):
+        "Answers a binary request, requests for instruments are queued for the instrument's executor."
+        opcode, resource_id, _, _ = proto.unpack_frame(data)
+        task = proto.TASKS.get(opcode & ~proto.DEADLINE_FLAG)
+        if task is None or task == "OPEN" or task in proto.CONNECTION_TASKS:
+            self.push(self.handle_binary(data))
+            return
+        try:
+            addr = self.visa_instruments.address_of(resource_id)
+        except ValueError: # answered with the error
+            self.push(self.handle_binary(data))
+            return
+        with self.in_flight_cond:
+            queue = self.queues.setdefault(resource_id, deque())
+            queue.append((data, time.monotonic()))
+            self.in_flight += 1
+            if len(queue) > 1: # submitted when the requests before are answered
+                return
+        self.executor(addr).submit(self.answer, addr, queue)
+    
+    def answer(self, addr, queue):
+        "Answers the first request of queue, then submits the next one."
+        data, received = queue[0]
+        try:
+            self.push(self.handle_binary(data, received))
+        except OSError: # client gone meanwhile
+            pass
+        finally:
+            with self.in_flight_cond:
+                queue.popleft()
+                self.in_flight -= 1
+                if not queue:
+                    self.in_flight_cond.notify_all()
+                    return
+            self.executor(addr).submit(self.answer, addr, queue)
+    
+    def cancel_requests(self):
+        "Drops the queued requests and waits for those executing."
+        with self.in_flight_cond:
+            for queue in self.queues.values():
+                while len(queue) > 1:
+                    queue.pop()
+                    self.in_flight -= 1
+            self.in_flight_cond.wait_for(lambda: self.in_flight == 0)
+    
+    def claim(self) -> bool:
+        "True for the first caller only, who then serves or rejects the connection."
+        return self.claimed.acquire(blocking=False)
+    
+    def reject(self, reason):
+        "Answers the requests of the client with an error until it disconnects or falls silent, then closes."
+        error = ConnectionRefusedError(reason)
+        try:
+            while self.readable(POLL_INTERVAL):
+                data = self.conn.recv_bytes()
+                if proto.is_binary(data):
+                    self.push(self.binary_error(proto.HEADER.unpack_from(data)[3], error))
+                else:
+                    self.push(pickle.dumps(f"ERROR {type(error)} {error}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.conn.close()
+    
+    def idle(self) -> bool:
+        "Whether the connection may be closed, nothing pending and no state the client relies on."
+        return self.binary_protocol and self.in_flight == 0 and not self.leases and not self.subscriptions
+    
+    def readable(self, timeout) -> bool:
+        if self.poller is not None:
+            return bool(self.poller.poll(timeout*1000))
+        return self.conn.poll(timeout)
+    
+    def wait_for_message(self) -> bool:
+        """
+        Waits until a message arrives, False if the server is closing or the
+        connection has been idle for idle_timeout.
+        """
+        interval = POLL_INTERVAL if self.idle_timeout is None else min(POLL_INTERVAL, self.idle_timeout)
+        idle_since = time.monotonic()
+        while not self.readable(interval):
+            if self.end_event.is_set():
+                return False
+            if not self.idle():
+                idle_since = time.monotonic()
+            elif self.idle_timeout is not None and time.monotonic() - idle_since >= self.idle_timeout:
+                log.info(f"Closing idle {self.name}")
+                return False
+        return not self.end_event.is_set()
+    
+    def run(self):
+        try:
+            while self.wait_for_message():
+                data = self.conn.recv_bytes()
+                if proto.is_binary(data):
+                    self.binary_protocol = True
+                    self.submit(data)
+                else:
+                    self.push(self.handle_string(data))
         except EOFError:
             pass
         except:
@@ -237,16 +1637,282 @@ class InstrumentClientHandler(thr.Thread):
             raise
         finally:
             log.info(f"quitting {self.name}")
-            self.conn.close()
-            self.finished.put(self.name)
+            self.unsubscribe_all()
+            self.unlock_all()
+            self.cancel_requests()
+            self.close_all()
+            self.release_segments()
+            self.stop_publishing()
+            with self.send_lock:
+                self.conn.close()
+
+class AsyncClientConnection(RequestDispatcher):
+    """
+    One client of the AsyncInstrumentServer. Binary requests for different
+    instruments are executed concurrently and answered as they finish (the client
+    matches the replies by request id), requests for the same instrument keep
+    their order. String protocol requests are answered strictly in order.
+    """
+    def __init__(self, server, reader, writer, name):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.visa_instruments = server.instruments
+        self.order_locks = {} # addr -> asyncio.Lock keeping per-instrument order
+        self.tasks = set()
+        self.segments = {} # name -> shared memory segment of this connection
+        self.free_segments = [] # names of segments released by the client
+        self.segments_lock = thr.Lock()
+        self.subscriptions = set()
+        self.leases = set() # addresses leased by this connection
+        self.opened = Counter() # VISA address -> OPENs of this connection not closed yet
+        self.opened_lock = thr.Lock()
+        self.loop = asyncio.get_running_loop()
+    
+    async def recv_bytes(self):
+        "Reads one message in the multiprocessing.connection framing."
+        return await proto.read_message(self.reader)
+    
+    def write_bytes(self, data):
+        "Writes one message in the multiprocessing.connection framing without waiting."
+        self.writer.write(proto.frame_message(data))
+    
+    async def send_bytes(self, data):
+        self.write_bytes(data)
+        await self.writer.drain()
+    
+    def push(self, frame):
+        if self.writer.is_closing():
+            raise ConnectionError(f"{self.name} is closed")
+        self.loop.call_soon_threadsafe(self.write_bytes, frame)
+    
+    def publish(self, frame):
+        "Published frames are dropped while the client does not read and the write buffer is full."
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]:
+            return
+        self.push(frame)
+    
+    async def run_binary(self, task, addr, cmd, request_id, size, deadline=None):
+        loop = asyncio.get_running_loop()
+        if task == "OPEN": # touches no instrument, need not wait for earlier requests
+            order_lock = nullcontext()
+        else:
+            order_lock = self.order_locks.setdefault(addr, asyncio.Lock())
+        async with order_lock:
+            reply = await loop.run_in_executor(self.server.executor(addr),
+                                               self.respond, task, addr, cmd, request_id, size, deadline)
+        await self.send_bytes(reply)
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await self.recv_bytes()
+                if not proto.is_binary(data):
+                    reply = await loop.run_in_executor(self.server.general_executor,
+                                                       self.handle_string, data)
+                    await self.send_bytes(reply)
+                    continue
+                try:
+                    task, addr, cmd, request_id, deadline = self.parse_frame(data)
+                except Exception as e:
+                    await self.send_bytes(self.binary_error(proto.HEADER.unpack_from(data)[3], e))
+                    continue
+                log.debug("%s recv'd: task=%s, addr=%s, request=%s", self.name, task, addr, request_id)
+                if task in proto.CONNECTION_TASKS:
+                    await self.send_bytes(self.handle_connection_task(task, cmd, request_id))
+                    continue
+                t = asyncio.create_task(self.run_binary(task, addr, cmd, request_id, len(data), deadline))
+                self.tasks.add(t)
+                t.add_done_callback(self.tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            log.info(f"quitting {self.name}")
+            for t in list(self.tasks):
+                t.cancel()
+            self.unsubscribe_all()
+            self.unlock_all()
+            self.release_segments()
+            self.writer.close()
+            try: # closing may wait for the bus to flush coalesced writes
+                await self.loop.run_in_executor(self.server.general_executor, self.close_all)
+            except RuntimeError: # executor shut down
+                self.close_all()
+
+class AsyncInstrumentServer:
+    """
+    asyncio based alternative to InstrumentClientListener. All clients are
+    multiplexed on one event loop and blocking VISA calls are handed to
+    per-instrument executors. Uses the same wire format and port file, so
+    InstrumentClient does not need to know which server it talks to.
+    
+    Each executor has several workers (threads are only started when needed),
+    so that requests of different clients for the same instrument wait in its
+    PriorityLock, which orders them by priority, rather than in the
+    first-come first-served executor queue.
+    """
+    def __init__(self, instruments, port=0, address=None, port_filename='instrument_server_port.txt',
+                 workers_per_instrument=16):
+        if address is None:
+            address = 'localhost'
+        
+        self.instruments = instruments
+        self.port = port
+        self.port_filename = os.path.join(tempfile.gettempdir(), port_filename)
+        self.address = (address, self.port)
+        self.unix_path = proto.unix_socket_path(self.port_filename)
+        self.unix_server = None
+        self.workers_per_instrument = workers_per_instrument
+        self.executors = {} # addr -> executor for its blocking VISA calls
+        self.general_executor = ThreadPoolExecutor(thread_name_prefix='general')
+        self.handler_id = 0
+        self.started = thr.Event() # set once the port is known
+    
+    def executor(self, addr):
+        if addr not in self.executors:
+            self.executors[addr] = ThreadPoolExecutor(max_workers=self.workers_per_instrument,
+                                                      thread_name_prefix=addr)
+        return self.executors[addr]
+    
+    async def start(self):
+        """
+        Opens the listening TCP and AF_UNIX sockets and saves the port number
+        and the socket path to a temporary file.
+        """
+        self.server = await asyncio.start_server(self.handle_client, *self.address)
+        sockname = self.server.sockets[0].getsockname()
+        self.port = sockname[1]
+        self.address = (sockname[0], self.port)
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path): # left over by a server that crashed
+                os.remove(self.unix_path)
+            self.unix_server = await asyncio.start_unix_server(self.handle_client, self.unix_path)
+        proto.write_port_file(self.port_filename, self.port, self.address[0], self.unix_path)
+        self.started.set()
+    
+    async def handle_client(self, reader, writer):
+        log.info(f"Accepted {writer.get_extra_info('peername') or self.unix_path}")
+        name = f"handler {self.handler_id}"
+        self.handler_id += 1
+        await AsyncClientConnection(self, reader, writer, name).run()
+    
+    async def serve(self):
+        "Starts the server and serves clients until cancelled."
+        await self.start()
+        servers = [self.server] if self.unix_server is None else [self.server, self.unix_server]
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+    
+    def close_server(self):
+        log.info("Shutting down executors.")
+        for executor in self.executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.general_executor.shutdown(wait=True, cancel_futures=True)
+        log.info(f"Removing {self.port_filename}")
+        if os.path.exists(self.port_filename):
+            os.remove(self.port_filename)
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+        log.info("Instrument server shutting down.")
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_server()
+        if exc_type is None:
+            return True
+        else: #propagate whatever exception happened
+            return False
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Shared VISA instrument server")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="multiplex all clients on one asyncio event loop instead of a thread per client")
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help="log the server statistics every this many seconds (0 = never)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record all VISA traffic to a binary log (see InstrumentRecorder)")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="serve the instruments recorded in a traffic log instead of real ones")
+    parser.add_argument('--directory', metavar='HOST:PORT',
+                        help="register the instruments with an InstrumentDirectory")
+    parser.add_argument('--advertise', metavar='HOST', default=socket.gethostname(),
+                        help="name of this host given to the directory (default: the host name)")
+    parser.add_argument('--instruments', nargs='+', metavar='ADDR',
+                        help="VISA addresses registered with the directory (default: all listed by VISA)")
+    parser.add_argument('--coalesce', nargs='+', metavar='ADDR[=WINDOW]', default=[],
+                        help="coalesce the writes to these SCPI instruments within WINDOW s (default 0.005)")
+    parser.add_argument('--max-handlers', type=int, default=64,
+                        help="connections served at a time by the threaded server")
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help="connections waiting for a handler before no more are accepted")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help=f"close binary protocol connections of the threaded server idle for this many "
+                             f"seconds (default {IDLE_TIMEOUT:g}, 0 = never)")
+    parser.add_argument('--pending-timeout', type=float, default=PENDING_TIMEOUT,
+                        help="turn away connections waiting this many seconds for a free handler")
+    parser.add_argument('--keep-open', type=float, default=60.0,
+                        help="keep instruments open this many seconds after their last client left (default 60)")
+    parser.add_argument('--prewarm', metavar='FILE',
+                        help="JSON file {address: {attribute: value}} of instruments to open and configure at startup")
+    args = parser.parse_args()
+    prewarm = None
+    if args.prewarm:
+        with open(args.prewarm) as file:
+            prewarm = json.load(file)
+    coalesce = {}
+    for item in args.coalesce:
+        addr, _, window = item.partition('=')
+        coalesce[addr] = float(window) if window else 0.005
     log.basicConfig(filename="instrument_server_log.txt",
                     format="%(asctime)s %(levelname)s:%(message)s",
                     level=log.INFO)
-    with (VISAInstruments() as instruments, 
-          InstrumentClientListener(instruments, address='') as server
-          ):
-        server.start()
-        server.loop()
-    
+    recorder = TrafficRecorder(args.record) if args.record else None
+    rm = ReplayResourceManager(args.replay) if args.replay else None
+    registration = None
+    try:
+        if args.asyncio:
+            with (VISAInstruments(resource_manager=rm, recorder=recorder, coalesce=coalesce,
+                                  keep_open=args.keep_open, prewarm=prewarm) as instruments,
+                  AsyncInstrumentServer(instruments, address='') as server
+                  ):
+                if args.stats_interval > 0:
+                    StatsLogger(instruments, args.stats_interval).start()
+                if args.directory:
+                    registration = DirectoryRegistration(args.directory, args.advertise,
+                                                         lambda: server.started.wait() and server.port,
+                                                         lambda: args.instruments or instruments.rm.list_resources())
+                    registration.start()
+                try:
+                    asyncio.run(server.serve())
+                except KeyboardInterrupt:
+                    pass
+        else:
+            with (VISAInstruments(resource_manager=rm, recorder=recorder, coalesce=coalesce,
+                                  keep_open=args.keep_open, prewarm=prewarm) as instruments, 
+                  InstrumentClientListener(instruments, address='', max_handlers=args.max_handlers,
+                                           max_pending=args.max_pending, idle_timeout=args.idle_timeout or None,
+                                           pending_timeout=args.pending_timeout) as server
+                  ):
+                if args.stats_interval > 0:
+                    StatsLogger(instruments, args.stats_interval).start()
+                server.start()
+                if args.directory:
+                    registration = DirectoryRegistration(args.directory, args.advertise, lambda: server.port,
+                                                         lambda: args.instruments or instruments.rm.list_resources())
+                    registration.start()
+                server.loop()
+    finally:
+        if registration is not None: # unregister right away instead of letting the registration expire
+            registration.stop()
+            registration.join(timeout=5)
+        if recorder is not None:
+            recorder.close()
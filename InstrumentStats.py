@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:37 2026
+
+Latency and throughput statistics of the instrument server. Everything is kept
+in fixed-size histograms and counters, so that collection is cheap enough to be
+always on.
+"""
+
+import time
+import bisect
+import threading as thr
+from collections import defaultdict
+
+MAX_HEADER_LENGTH = 32 # longer command headers are cut, so that odd commands cannot flood the tables
+
+def command_header(msg: str) -> str:
+    "The command up to its first space, e.g. 'FREQ?' for 'FREQ? 1', which the latencies are kept by."
+    return msg.strip().split(' ', 1)[0][:MAX_HEADER_LENGTH]
+
+class Histogram:
+    "Thread-safe histogram of durations in s on logarithmic buckets from 10 us to ~15 min."
+    bounds = [1e-5*2**(k/2) for k in range(54)]
+    
+    def __init__(self):
+        self.lock = thr.Lock()
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, value: float):
+        k = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[k] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+    
+    def quantile(self, q: float) -> float:
+        "Upper bound of the bucket containing the q-quantile."
+        target = q*self.count
+        seen = 0
+        for k, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(self.bounds[k], self.max) if k < len(self.bounds) else self.max
+        return 0.0
+    
+    def summary(self) -> dict:
+        with self.lock:
+            if self.count == 0:
+                return {'count': 0}
+            return {'count': self.count,
+                    'mean': self.total/self.count,
+                    'p50': self.quantile(0.5),
+                    'p90': self.quantile(0.9),
+                    'p99': self.quantile(0.99),
+                    'max': self.max}
+
+class ServerStats:
+    """
+    Per-instrument and per-command latencies, lock wait times, queue depths
+    and bytes transferred.
+    """
+    def __init__(self):
+        self.lock = thr.Lock() # only for creating new entries
+        self.started = time.time()
+        self.latency = {} # (addr, task, command header or None) -> Histogram of the request handling time
+        self.lock_wait = {} # addr -> Histogram of the time waiting for the resource
+        self.max_queue_depth = defaultdict(int) # addr -> most waiters seen
+        self.bytes_in = defaultdict(int) # addr -> request bytes
+        self.bytes_out = defaultdict(int) # addr -> reply bytes
+        self.expired = defaultdict(int) # addr -> requests dropped because of their deadline
+    
+    def histogram(self, table: dict, key) -> Histogram:
+        hist = table.get(key)
+        if hist is None:
+            with self.lock:
+                hist = table.setdefault(key, Histogram())
+        return hist
+    
+    def record_request(self, addr, task: str, duration: float, bytes_in: int, bytes_out: int, command=None):
+        "command is the SCPI command of the request, if any, its header is kept."
+        header = None if command is None else command_header(command)
+        self.histogram(self.latency, (addr, task, header)).add(duration)
+        self.bytes_in[addr] += bytes_in
+        self.bytes_out[addr] += bytes_out
+    
+    def record_lock_wait(self, addr: str, wait: float, queue_depth: int):
+        "queue_depth is the number of requests already waiting on arrival."
+        self.histogram(self.lock_wait, addr).add(wait)
+        if queue_depth > self.max_queue_depth[addr]:
+            self.max_queue_depth[addr] = queue_depth
+    
+    def record_expired(self, addr: str):
+        self.expired[addr] += 1
+    
+    def snapshot(self, queue_depths=None) -> dict:
+        """
+        All statistics as a JSON-serializable dictionary.
+    
+        Parameters
+        ----------
+        queue_depths : dict, optional
+            Current number of waiting requests per instrument.
+        """
+        instruments = {}
+        def entry(addr):
+            return instruments.setdefault(str(addr), {'commands': {}})
+        for (addr, task, header), hist in list(self.latency.items()):
+            entry(addr)['commands'][task if header is None else f"{task} {header}"] = hist.summary()
+        for addr, hist in list(self.lock_wait.items()):
+            entry(addr)['lock_wait'] = hist.summary()
+        for addr, depth in list(self.max_queue_depth.items()):
+            entry(addr)['max_queue_depth'] = depth
+        for addr, depth in (queue_depths or {}).items():
+            entry(addr)['queue_depth'] = depth
+        for addr, count in list(self.expired.items()):
+            entry(addr)['expired'] = count
+        for addr in list(self.bytes_in):
+            entry(addr)['bytes_in'] = self.bytes_in[addr]
+            entry(addr)['bytes_out'] = self.bytes_out[addr]
+        return {'uptime': time.time() - self.started,
+                'bytes_in': sum(self.bytes_in.values()),
+                'bytes_out': sum(self.bytes_out.values()),
+                'instruments': instruments}
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:05:21 2026
+
+Simulated VISA resources for running InstrumentServer without hardware, e.g.
+
+    VISAInstruments(resource_manager=MockResourceManager(latency=0.002))
+
+Every resource answers any command after a configurable delay, which stands
+in for the bus and instrument time of real hardware.
+"""
+
+import time
+import struct
+
+class MockResource:
+    """
+    Stand-in for a pyvisa MessageBasedResource. Writes are accepted and counted,
+    queries and reads return response_size characters (or the size of the
+    command in sizes), binary queries binary_size bytes.
+    """
+    def __init__(self, resource_name, manager):
+        self.resource_name = resource_name
+        self.manager = manager
+        self.timeout = 2000
+        self.writes = 0
+        self.queries = 0
+    
+    def delay(self, msg):
+        latency = self.manager.latency_of(msg)
+        if latency > 0:
+            time.sleep(latency)
+    
+    def write(self, msg):
+        self.delay(msg)
+        self.writes += 1
+        return len(msg)
+    
+    def read(self):
+        self.delay('')
+        return self.manager.response_of('')
+    
+    def query(self, msg):
+        self.delay(msg)
+        self.queries += 1
+        return self.manager.response_of(msg)
+    
+    def query_binary_values(self, msg, datatype='f', is_big_endian=False, container=list,
+                            header_fmt='ieee', expect_termination=True, data_points=0, chunk_size=None):
+        "Like pyvisa's from_binary_block, the block is unpacked before container is applied."
+        self.delay(msg)
+        self.queries += 1
+        size = struct.calcsize(datatype)
+        count = data_points or self.manager.binary_size//size
+        data = bytes(count*size)
+        values = struct.unpack(('>' if is_big_endian else '<') + f'{count}{datatype}', data)
+        if datatype in 'sp':
+            values = values[0]
+        return container(values)
+    
+    def clear(self):
+        pass
+    
+    def close(self):
+        pass
+
+class MockResourceManager:
+    """
+    Stand-in for pyvisa.ResourceManager, opens a MockResource for any address.
+    
+    Parameters
+    ----------
+    latency : float, optional
+        Time in s every command takes.
+    latencies : dict, optional
+        Latencies of particular commands, by the command header (the message
+        up to the first space, e.g. 'FREQ?').
+    response_size : int, optional
+        Length of the responses to queries and reads.
+    sizes : dict, optional
+        Response lengths of particular commands, by the command header like
+        latencies.
+    binary_size : int, optional
+        Size in bytes of the data returned by query_binary_values.
+    """
+    def __init__(self, latency=0.0, latencies=None, response_size=16, binary_size=4096, sizes=None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.response = '1' * response_size
+        self.responses = {header: '1' * size for header, size in (sizes or {}).items()}
+        self.binary_size = binary_size
+        self.resources = {}
+    
+    def latency_of(self, msg):
+        return self.latencies.get(msg.split(' ', 1)[0], self.latency)
+    
+    def response_of(self, msg):
+        return self.responses.get(msg.split(' ', 1)[0], self.response)
+    
+    def open_resource(self, resource_name, **kwargs):
+        resource = MockResource(resource_name, self)
+        self.resources[resource_name] = resource
+        return resource
+    
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.resources)
+    
+    def close(self):
+        self.resources.clear()
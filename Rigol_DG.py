@@ -108,17 +108,16 @@ class Rigol_DG(Instrument):
         channel = self.parse_channel(channel)
         pref = f':SOUR{channel}:'
         if enable:
-            self.dev.write(pref+"FREQ:STAR {:.3f}".format(fi))
-            self.dev.write(pref+"FREQ:STOP {:.3f}".format(ff))
-            self.dev.write(pref+"SWE:SPAC LIN")
-            self.dev.write(pref+"SWE:TIME {:.3f}".format(t))
             if extTrig:
                 print(pref+"TRIG:SOUR EXT")
-                self.dev.write(pref+"SWE:TRIG:SOUR EXT")
-            else:
-                self.dev.write(pref+"SWE:TRIG:SOUR MAN")
-            self.dev.write(pref+"SWE:TRIG:SLOP POS")
-            self.dev.write(pref+"SWE:STAT ON")
+            self.sequence('frequency_sweep', [('write', "{pref}FREQ:STAR {fi:.3f}"),
+                                              ('write', "{pref}FREQ:STOP {ff:.3f}"),
+                                              ('write', "{pref}SWE:SPAC LIN"),
+                                              ('write', "{pref}SWE:TIME {t:.3f}"),
+                                              ('write', "{pref}SWE:TRIG:SOUR {source}"),
+                                              ('write', "{pref}SWE:TRIG:SLOP POS"),
+                                              ('write', "{pref}SWE:STAT ON")],
+                          pref=pref, fi=fi, ff=ff, t=t, source='EXT' if extTrig else 'MAN')
         else:
             self.dev.write(pref+"TRIG:SOUR IMM")
             self.dev.write(pref+"SWE:STAT OFF")
@@ -10,8 +10,8 @@ from .Instrument import Instrument
 class SG384(Instrument):
     """Stanford SG384 signal generator (up-to 4 GHz)"""
     
-    def __init__(self, rm, address):
-        super().__init__(rm, address)
+    def __init__(self, rm, address, **kwargs):
+        super().__init__(rm, address, **kwargs)
         
     def output(self, outp=None):
         if outp is None:
@@ -60,11 +60,12 @@ class SG384(Instrument):
         
     def extAM(self, enable=True, depth=100):
         if enable:
-            self.dev.write('TYPE 0') # select AM modulation
-            self.dev.write('COUP 1') # DC coupling for the AM input
-            self.dev.write('MFNC 5') # external source for AM
-            self.dev.write('ADEP {:.1f}'.format(depth)) #modulation depth in %
-            self.dev.write('MODL 1') #enable modulation
+            self.sequence('extAM', [('write', 'TYPE 0'), # select AM modulation
+                                    ('write', 'COUP 1'), # DC coupling for the AM input
+                                    ('write', 'MFNC 5'), # external source for AM
+                                    ('write', 'ADEP {depth:.1f}'), #modulation depth in %
+                                    ('write', 'MODL 1')], #enable modulation
+                          depth=depth)
         else:
             self.dev.write('MODL 0') #disable modulation
     
@@ -341,10 +341,7 @@ class SR830(Instrument):
         return float(self.dev.query('FREQ?'))
     
     def get_xy(self):
-        resp = self.dev.query("SNAP? 1,2")
-        xstr, ystr = resp.split(',')
-        x = float(xstr)
-        y = float(ystr)
+        x, y = self.dev.query_ascii_values("SNAP? 1,2")
         return x, y
     
     def auto_sens(self, maxval, do_set=True):
@@ -470,6 +467,12 @@ class SR830(Instrument):
         if N > 16383:
             raise Exception('Maximum number of measured points (16383) exceeded!')
         
+        sample_rate_float = 0.0625*2**i
+        if self.access_mode == 'socket' and self.dev.protocol == 'binary':
+            CH1, CH2 = self.buffer_job(N, N/sample_rate_float, debug)
+            self.buffer_X = CH1.tolist()
+            self.buffer_Y = CH2.tolist()
+            return CH1, CH2
        
         with ILock('aaa'):
             self.dev.write('PAUS')
@@ -477,7 +480,6 @@ class SR830(Instrument):
             self.dev.write('STRT')
         j = 0
         
-        sample_rate_float = 0.0625*2**i
         time.sleep(N/sample_rate_float +2)
         
         with ILock('aaa'):
@@ -514,6 +516,53 @@ class SR830(Instrument):
     
         return CH1,CH2
     
+    def buffer_job(self, N, duration, debug=False):
+        """
+        Buffer measurement of buffer_shot as a job of the instrument server. The
+        server polls the lockin and transfers the buffer in chunks while the
+        requests of other clients are served, this client only collects the
+        chunks.
+
+        Parameters
+        ----------
+        N : int
+            number of measured points
+        duration : float
+            expected duration of the measurement in s
+        debug : bool
+            print progress
+
+        Returns
+        -------
+        CH1 : numpy array
+            measured CH1 display points
+        CH2 : numpy array
+            measured CH2 display points
+        """
+        interval = min(2, max(duration/20, 0.1))
+        job = self.dev.start_job(['TRCB? 1,{start},{count}', 'TRCB? 2,{start},{count}'], N, 'SPTS?',
+                                 interval=interval,
+                                 start=[('write', 'PAUS'), ('write', 'REST'), ('write', 'STRT')],
+                                 finish=[('write', 'PAUS')], datatype='f', header_fmt='empty')
+        X_chunks = []
+        Y_chunks = []
+        try:
+            done = False
+            while not done:
+                time.sleep(interval)
+                done, (X, Y) = self.dev.fetch_job(job)
+                X_chunks.append(X)
+                Y_chunks.append(Y)
+                if debug:
+                    print(f'\rPoints transferred: {sum(map(len, X_chunks))}/{N}', end='')
+        except BaseException:
+            if job in self.dev.jobs:
+                self.dev.cancel_job(job)
+            raise
+        finally:
+            self.dev.write('REST')
+        return np.concatenate(X_chunks).astype(float), np.concatenate(Y_chunks).astype(float)
+    
     def get_settings(self):
         """
         Return the device settings as a dictionary. \n
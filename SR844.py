@@ -219,10 +219,7 @@ class SR844(Instrument):
         return float(self.dev.query('FRIQ?'))
     
     def get_xy(self):
-        resp = self.dev.query("SNAP? 1,2")
-        xstr, ystr = resp.split(',')
-        x = float(xstr)
-        y = float(ystr)
+        x, y = self.dev.query_ascii_values("SNAP? 1,2")
         return x, y
     
     def auto_sens(self, maxval, do_set=True):
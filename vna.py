@@ -87,19 +87,14 @@ class VNA(Instrument):
 
         self.dev.write(":FORM:DATA ASC")
 
-        data3 = self.dev.query(":CALC1:TRAC3:DATA:FDATa?")
-        polar = data3.split(",")
-        polar = np.array(polar,dtype=float)
+        polar = self.dev.query_ascii_values(":CALC1:TRAC3:DATA:FDATa?", container=np.array)
         polar = np.reshape(polar, [num_points,2])
 
         x = polar[:,0]
         y = polar[:,1]
 
         #frequency data
-        self.dev.write(":SENS1:FREQ:DATA?")
-        frequency = self.dev.read()
-        freq = frequency.split(",")
-        freq = np.array(freq,dtype=float)
+        freq = self.dev.query_ascii_values(":SENS1:FREQ:DATA?", container=np.array)
         data = np.column_stack((freq,x,y))
         return data
     